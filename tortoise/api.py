@@ -1,6 +1,9 @@
+import functools
 import os
 import random
 import uuid
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
 from time import time
 from urllib import request
 
@@ -15,16 +18,20 @@ from tortoise.models.diffusion_decoder import DiffusionTts
 from tortoise.models.autoregressive import UnifiedVoice
 from tqdm import tqdm
 
-from tortoise.models.arch_util import TorchMelSpectrogram
+from tortoise.models.arch_util import get_torch_mel_spectrogram
 from tortoise.models.clvp import CLVP
 from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
-from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, space_timesteps_by_log_snr, get_named_beta_schedule
+from tortoise.utils.latent_store import LatentStore
+from tortoise.utils.residency import ModelResidency
+from tortoise.utils.text import iter_split_and_recombine_text
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
+from tortoise.utils.voice_cache import VOICE_CACHE_DIR, VoiceCache, checkpoint_fingerprint, hash_tensor
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
-from tortoise.scripts.stt import check_texts_approx_match
+from tortoise.utils.qa import QAPolicy
 
 pbar = None
 
@@ -94,18 +101,33 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+# Number of diffusers kept by load_discrete_vocoder_diffuser(), and of timestep embeddings kept by each TextToSpeech.
+DIFFUSER_CACHE_SIZE = 16
+
+
+@functools.lru_cache(maxsize=DIFFUSER_CACHE_SIZE)
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1,
+                                   fuse_cond_free=False, log_snr_spacing=False):
     """
-    Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
+    Helper function to load a GaussianDiffusion instance configured for use as a vocoder. Instances are cached, since
+    they hold no state between sampling runs and building the schedule is not free.
+    If fuse_cond_free is set, the conditioning-free passes are run as one batch (see DiffusionTts.forward).
+    If log_snr_spacing is set, the diffusion steps are spaced evenly in log-SNR rather than in time, which suits the
+    'dpm_solver' sampler.
     """
-    return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
-                           model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+    betas = get_named_beta_schedule('linear', trained_diffusion_steps)
+    if log_snr_spacing:
+        use_timesteps = space_timesteps_by_log_snr(betas, desired_diffusion_steps)
+    else:
+        use_timesteps = space_timesteps(trained_diffusion_steps, [desired_diffusion_steps])
+    return SpacedDiffusion(use_timesteps=use_timesteps, model_mean_type='epsilon',
+                           model_var_type='learned_range', loss_type='mse', betas=betas,
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k, fuse_conditioning_free=fuse_cond_free)
 
 
-def format_conditioning(clip, cond_length=132300, device='cuda'):
+def crop_conditioning(clip, cond_length=132300):
     """
-    Converts the given conditioning signal to a MEL spectrogram and clips it as expected by the models.
+    Pads the given conditioning signal with silence, or crops it at random, to cond_length samples.
     """
     gap = clip.shape[-1] - cond_length
     if gap < 0:
@@ -113,8 +135,50 @@ def format_conditioning(clip, cond_length=132300, device='cuda'):
     elif gap > 0:
         rand_start = random.randint(0, gap)
         clip = clip[:, rand_start:rand_start + cond_length]
-    mel_clip = TorchMelSpectrogram()(clip.unsqueeze(0)).squeeze(0)
-    return mel_clip.unsqueeze(0).to(device)
+    return clip
+
+
+def format_conditioning(clip, cond_length=132300, device='cuda'):
+    """
+    Converts the given conditioning signal to a MEL spectrogram and clips it as expected by the models.
+    """
+    return format_conditioning_batch([clip], cond_length, device)[0]
+
+
+def format_conditioning_batch(clips, cond_length=132300, device='cuda'):
+    """
+    Like format_conditioning(), but converts a list of conditioning signals as one batch. Returns a (1,n,80,s) tensor,
+    as expected by UnifiedVoice.get_conditioning().
+    """
+    clips = torch.cat([crop_conditioning(clip, cond_length) for clip in clips], dim=0)
+    mel_clips = get_torch_mel_spectrogram(clips.device)(clips)
+    return mel_clips.unsqueeze(0).to(device)
+
+
+def pad_latent(latent, length):
+    """
+    Forces the (s,d) autoregressive latent <latent> to have the specified sequence length, either by clipping it or by
+    repeating its last element.
+    """
+    if latent.shape[0] >= length:
+        return latent[:length]
+    return torch.cat([latent, latent[-1:].repeat(length - latent.shape[0], 1)], dim=0)
+
+
+def trim_latents_at_silence(codes, latents, calm_token=83):
+    """
+    Finds the first run of "calm" tokens (the code for silence, which is fixed in place with fix_autoregressive_output)
+    in the given (1,s) codes and trims the (1,s,d) latents to it.
+    """
+    ctokens = 0
+    for k in range(codes.shape[-1]):
+        if codes[0, k] == calm_token:
+            ctokens += 1
+        else:
+            ctokens = 0
+        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+            return latents[:, :k]
+    return latents
 
 
 def fix_autoregressive_output(codes, stop_token, complain=True):
@@ -147,20 +211,110 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     return codes
 
 
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
+def spectrogram_length(latent_length):
+    """
+    Returns the number of MEL frames the diffusion model produces for <latent_length> autoregressive latents.
+    """
+    return latent_length * 4 * 24000 // 22050  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
+
+
+def split_into_windows(x, window, overlap):
+    """
+    Splits the (b,c,s) tensor <x> into windows of <window> frames along its last dimension, each overlapping the previous
+    one by at least <overlap> frames. The last window is aligned with the end of <x>.
+    :return: A tuple of the (n*b,c,window) windows, ordered window by window, and the start frame of each window.
+    """
+    length = x.shape[-1]
+    starts = list(range(0, length - window, window - overlap)) + [length - window]
+    return torch.cat([x[:, :, start:start + window] for start in starts], dim=0), starts
+
+
+def stitch_windows(windows, starts, length):
+    """
+    Reverses split_into_windows(): reassembles (n*b,c,window) windows into a (b,c,length) tensor, crossfading linearly
+    between windows wherever they overlap.
+    """
+    window = windows.shape[-1]
+    windows = windows.view(len(starts), -1, *windows.shape[1:])
+    out = torch.zeros(*windows.shape[1:-1], length, device=windows.device, dtype=windows.dtype)
+    total_weight = torch.zeros(length, device=windows.device, dtype=windows.dtype)
+    for i, start in enumerate(starts):
+        weight = torch.ones(window, device=windows.device, dtype=windows.dtype)
+        if i > 0:
+            overlap = starts[i - 1] + window - start
+            weight[:overlap] = torch.arange(1, overlap + 1, device=weight.device) / (overlap + 1)
+        if i < len(starts) - 1:
+            overlap = start + window - starts[i + 1]
+            fade_out = torch.arange(overlap, 0, -1, device=weight.device) / (overlap + 1)
+            weight[window - overlap:] = torch.minimum(weight[window - overlap:], fade_out)
+        out[:, :, start:start + window] += windows[i] * weight
+        total_weight[start:start + window] += weight
+    return out / total_weight
+
+
+DIFFUSION_SAMPLERS = ('p_sample', 'ddim', 'dpm_solver')
+
+
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True,
+                             timestep_embeddings=None, sampler='p_sample', ddim_eta=0.0, adaptive_tolerance=None,
+                             return_num_steps=False, window=None, window_overlap=32):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
+    :param sampler: One of DIFFUSION_SAMPLERS. 'p_sample' is ancestral sampling, 'ddim' is DDIM with the given ddim_eta
+                    and 'dpm_solver' is the second order multistep DPM-Solver++.
+    :param adaptive_tolerance: If given, each spectrogram stops being diffused once its predicted output changes by less
+                               than this fraction between two steps. See GaussianDiffusion.p_sample_loop().
+    :param return_num_steps: If true, also returns a list with the number of diffusion steps each spectrogram took.
+    :param window: If given, spectrograms longer than this many frames are diffused as a batch of overlapping windows of
+                   this length, which are crossfaded back together. This keeps the cost of attention linear in the
+                   length of the spectrogram.
+    :param window_overlap: Minimum number of frames shared by neighbouring windows.
     """
     with torch.no_grad():
-        output_seq_len = latents.shape[1] * 4 * 24000 // 22050  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
+        output_seq_len = spectrogram_length(latents.shape[1])
         output_shape = (latents.shape[0], 100, output_seq_len)
         precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
 
         noise = torch.randn(output_shape, device=latents.device) * temperature
-        mel = diffuser.p_sample_loop(diffusion_model, output_shape, noise=noise,
-                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
-                                     progress=verbose)
-        return denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
+        starts = None
+        if window is not None and output_seq_len > window:
+            if not 0 <= window_overlap < window:
+                raise ValueError(f'window_overlap must be in [0, {window}), got {window_overlap}')
+            # The windows share the same noise and embeddings wherever they overlap, so they agree closely there.
+            noise, starts = split_into_windows(noise, window, window_overlap)
+            precomputed_embeddings, _ = split_into_windows(precomputed_embeddings, window, window_overlap)
+            output_shape = tuple(noise.shape)
+        model_kwargs = {'precomputed_aligned_embeddings': precomputed_embeddings}
+        if timestep_embeddings is not None:
+            model_kwargs['timestep_embeddings'] = timestep_embeddings
+        loop_kwargs = {'noise': noise, 'model_kwargs': model_kwargs, 'progress': verbose,
+                       'adaptive_tolerance': adaptive_tolerance, 'return_num_steps': True}
+        if sampler == 'p_sample':
+            mel, num_steps = diffuser.p_sample_loop(diffusion_model, output_shape, **loop_kwargs)
+        elif sampler == 'ddim':
+            mel, num_steps = diffuser.ddim_sample_loop(diffusion_model, output_shape, eta=ddim_eta, **loop_kwargs)
+        elif sampler == 'dpm_solver':
+            mel, num_steps = diffuser.dpm_solver_sample_loop(diffusion_model, output_shape, **loop_kwargs)
+        else:
+            raise ValueError(f'Unknown diffusion sampler {sampler}. Options are: {", ".join(DIFFUSION_SAMPLERS)}')
+        if starts is not None:
+            mel = stitch_windows(mel, starts, output_seq_len)
+            num_steps = num_steps.view(len(starts), -1).max(dim=0).values
+        mel = denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
+        if return_num_steps:
+            return mel, num_steps.tolist()
+        return mel
+
+
+def reject_unsupported_kwargs(method, kwargs, unsupported):
+    """
+    Raises a TypeError if kwargs holds any of the names in unsupported. Used by the variants of tts() which forward
+    extra keyword args to the huggingface generate API, so that tts() options they do not support are not silently
+    passed on to it.
+    """
+    rejected = [name for name in unsupported if name in kwargs]
+    if rejected:
+        raise TypeError(f"{method}() does not support the tts() argument(s): {', '.join(rejected)}")
 
 
 def classify_audio_clip(clip):
@@ -200,7 +354,9 @@ class TextToSpeech:
     Main entry point into Tortoise.
     """
 
-    def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, enable_redaction=True, device=None):
+    def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, enable_redaction=True, device=None,
+                 keep_models_resident=False, resident_memory_budget_gb=None, voice_cache_dir=VOICE_CACHE_DIR,
+                 voice_cache_size_gb=1.0):
         """
         Constructor
         :param autoregressive_batch_size: Specifies how many samples to generate per batch. Lower this if you are seeing
@@ -211,21 +367,37 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param keep_models_resident: When true, models stay on the device after they are used instead of being moved
+                                     back to the CPU at the end of every call. This is a good choice for long-running
+                                     processes that generate many clips. Default is false.
+        :param resident_memory_budget_gb: Maximum amount of model weights (in GB) to keep resident on the device when
+                                          keep_models_resident is set. The least recently used models are moved back to
+                                          the CPU when the budget is exceeded. If omitted, no limit is applied.
+        :param voice_cache_dir: Directory in which conditioning latents computed by get_conditioning_latents() are
+                                cached, keyed by the voice clips and model checkpoints they were computed from. Set to
+                                None to disable the cache.
+        :param voice_cache_size_gb: Maximum size of the voice cache directory, in GB. The least recently used entries
+                                    are deleted when it grows larger.
         """
         self.models_dir = models_dir
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
         self.enable_redaction = enable_redaction
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        memory_budget = None if resident_memory_budget_gb is None else int(resident_memory_budget_gb * (1024 ** 3))
+        self.residency = ModelResidency(self.device, enabled=keep_models_resident, memory_budget=memory_budget)
         if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
+            self.aligner = Wav2VecAlignment(residency=self.residency)
 
         self.tokenizer = VoiceBpeTokenizer()
 
         if os.path.exists(f'{models_dir}/autoregressive.ptt'):
             # Assume this is a traced directory.
+            conditioning_checkpoints = [f'{models_dir}/autoregressive.ptt', f'{models_dir}/diffusion_decoder.ptt']
             self.autoregressive = torch.jit.load(f'{models_dir}/autoregressive.ptt')
             self.diffusion = torch.jit.load(f'{models_dir}/diffusion_decoder.ptt')
+            self.fuse_cond_free = False  # Traced models only support separate conditioning-free passes.
         else:
+            conditioning_checkpoints = [get_model_path('autoregressive.pth', models_dir), get_model_path('diffusion_decoder.pth', models_dir)]
             self.autoregressive = UnifiedVoice(max_mel_tokens=604, max_text_tokens=402, max_conditioning_inputs=2, layers=30,
                                           model_dim=1024,
                                           heads=16, number_text_tokens=255, start_text_token=255, checkpointing=False,
@@ -236,6 +408,16 @@ class TextToSpeech:
                                           in_latent_channels=1024, in_tokens=8193, dropout=0, use_fp16=False, num_heads=16,
                                           layer_drop=0, unconditioned_percentage=0).cpu().eval()
             self.diffusion.load_state_dict(torch.load(get_model_path('diffusion_decoder.pth', models_dir)))
+            self.fuse_cond_free = True
+
+        self.voice_cache = None
+        if voice_cache_dir is not None:
+            try:
+                self.voice_cache = VoiceCache(voice_cache_dir, max_size_bytes=int(voice_cache_size_gb * (1024 ** 3)))
+                self.conditioning_fingerprint = checkpoint_fingerprint(conditioning_checkpoints)
+            except OSError:
+                print(f"Unable to create the voice cache in {voice_cache_dir}. Conditioning latents will not be cached.")
+                self.voice_cache = None
 
         self.clvp = CLVP(dim_text=768, dim_speech=768, dim_latent=768, num_text_tokens=256, text_enc_depth=20,
                          text_seq_len=350, text_heads=12,
@@ -253,6 +435,10 @@ class TextToSpeech:
         self.rlg_diffusion = None
 
         self.stt = None
+        # Number of diffusion steps taken by each clip produced by the last call to tts(), tts_batch() or tts_stream().
+        self.diffusion_steps = []
+        # (timestep schedule, device) -> see get_timestep_embeddings(). Ordered from least to most recently used.
+        self.timestep_embeddings = OrderedDict()
 
     def load_cvvp(self):
         """Load CVVP model."""
@@ -260,39 +446,48 @@ class TextToSpeech:
                          speech_enc_depth=8, speech_mask_percentage=0, latent_multiplier=1).cpu().eval()
         self.cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
 
-    def get_conditioning_latents(self, voice_samples, return_mels=False):
+    def get_conditioning_latents(self, voice_samples, return_mels=False, use_cache=True):
         """
         Transforms one or more voice_samples into a tuple (autoregressive_conditioning_latent, diffusion_conditioning_latent).
         These are expressive learned latents that encode aspects of the provided clips like voice, intonation, and acoustic
         properties.
         :param voice_samples: List of 2 or more ~10 second reference clips, which should be torch tensors containing 22.05kHz waveform data.
+        :param use_cache: Whether or not to look up and store the result in the voice cache (see voice_cache_dir). Clips
+                          longer than the conditioning length are cropped at random, so the cached result is computed
+                          from the crop picked the first time the clips were seen.
         """
+        if not isinstance(voice_samples, list):
+            voice_samples = [voice_samples]
+        key = None
+        if use_cache and self.voice_cache is not None:
+            key = VoiceCache.make_key('conditioning', self.conditioning_fingerprint, *[hash_tensor(v) for v in voice_samples])
+            cached = self.voice_cache.get(key)
+            if cached is not None:
+                cached = tuple(c.to(self.device) for c in cached)
+                return cached if return_mels else cached[:2]
+
         with torch.no_grad():
             voice_samples = [v.to(self.device) for v in voice_samples]
 
-            auto_conds = []
-            if not isinstance(voice_samples, list):
-                voice_samples = [voice_samples]
-            for vs in voice_samples:
-                auto_conds.append(format_conditioning(vs, device=self.device))
-            auto_conds = torch.stack(auto_conds, dim=1)
-            self.autoregressive = self.autoregressive.to(self.device)
-            auto_latent = self.autoregressive.get_conditioning(auto_conds)
-            self.autoregressive = self.autoregressive.cpu()
-
-            diffusion_conds = []
-            for sample in voice_samples:
-                # The diffuser operates at a sample rate of 24000 (except for the latent inputs)
-                sample = torchaudio.functional.resample(sample, 22050, 24000)
-                sample = pad_or_truncate(sample, 102400)
-                cond_mel = wav_to_univnet_mel(sample.to(self.device), do_normalization=False, device=self.device)
-                diffusion_conds.append(cond_mel)
-            diffusion_conds = torch.stack(diffusion_conds, dim=1)
-
-            self.diffusion = self.diffusion.to(self.device)
-            diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
-            self.diffusion = self.diffusion.cpu()
+            auto_conds = format_conditioning_batch(voice_samples, device=self.device)
+            with self.residency.use(self, 'autoregressive'):
+                auto_latent = self.autoregressive.get_conditioning(auto_conds)
+
+            # The diffuser operates at a sample rate of 24000 (except for the latent inputs)
+            diffusion_samples = [pad_or_truncate(torchaudio.functional.resample(sample, 22050, 24000), 102400)
+                                 for sample in voice_samples]
+            diffusion_conds = wav_to_univnet_mel(torch.cat(diffusion_samples, dim=0), do_normalization=False,
+                                                 device=self.device).unsqueeze(0)
+
+            with self.residency.use(self, 'diffusion'):
+                diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
 
+        if key is not None:
+            try:
+                self.voice_cache.put(key, tuple(c.cpu() for c in (auto_latent, diffusion_latent, auto_conds, diffusion_conds)))
+            except OSError:
+                print(f"Unable to write to the voice cache in {self.voice_cache.cache_dir}. Conditioning latents will not be cached.")
+                self.voice_cache = None
         if return_mels:
             return auto_latent, diffusion_latent, auto_conds, diffusion_conds
         else:
@@ -315,6 +510,34 @@ class TextToSpeech:
             'fast': Decent quality speech at a decent inference rate. A good choice for mass inference.
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
+            'fast_ddim': Like 'fast', but uses the DDIM sampler, which needs far fewer diffusion steps for similar quality.
+            'standard_ddim': Like 'standard', but uses the DDIM sampler, which needs far fewer diffusion steps for similar quality.
+            'fast_dpm', 'standard_dpm': Like 'fast' and 'standard', but use DPM-Solver++, which needs even fewer steps than DDIM.
+        """
+        return self.tts(text, **self.preset_settings(preset, **kwargs))
+
+    def tts_stream_with_preset(self, text, preset='fast', **kwargs):
+        """
+        Calls tts_stream() with one of the presets described in tts_with_preset().
+        """
+        return self.tts_stream(text, **self.preset_settings(preset, **kwargs))
+
+    def tts_batch_with_preset(self, texts, preset='fast', **kwargs):
+        """
+        Calls tts_batch() with one of the presets described in tts_with_preset().
+        """
+        return self.tts_batch(texts, **self.preset_settings(preset, **kwargs))
+
+    def iter_tts_batch_with_preset(self, texts, preset='fast', **kwargs):
+        """
+        Calls iter_tts_batch() with one of the presets described in tts_with_preset().
+        """
+        return self.iter_tts_batch(texts, **self.preset_settings(preset, **kwargs))
+
+    @staticmethod
+    def preset_settings(preset, **kwargs):
+        """
+        Returns the generation settings for the given preset, overridden by kwargs.
         """
         # Use generally found best tuning knobs for generation.
         settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
@@ -326,20 +549,28 @@ class TextToSpeech:
             'fast': {'num_autoregressive_samples': 96, 'diffusion_iterations': 80},
             'standard': {'num_autoregressive_samples': 256, 'diffusion_iterations': 200},
             'high_quality': {'num_autoregressive_samples': 256, 'diffusion_iterations': 400},
+            'fast_ddim': {'num_autoregressive_samples': 96, 'diffusion_iterations': 30, 'diffusion_sampler': 'ddim'},
+            'standard_ddim': {'num_autoregressive_samples': 256, 'diffusion_iterations': 50, 'diffusion_sampler': 'ddim'},
+            'fast_dpm': {'num_autoregressive_samples': 96, 'diffusion_iterations': 15, 'diffusion_sampler': 'dpm_solver'},
+            'standard_dpm': {'num_autoregressive_samples': 256, 'diffusion_iterations': 20, 'diffusion_sampler': 'dpm_solver'},
         }
         settings.update(presets[preset])
         settings.update(kwargs) # allow overriding of preset settings with kwargs
-        return self.tts(text, **settings)
+        return settings
 
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
             return_deterministic_state=False,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            keep_autoregressive_latents=False, latent_memory_budget_gb=1.0,
+            adaptive_sampling=False, min_autoregressive_samples=32, clvp_score_threshold=None, clvp_patience=2,
             # CVVP parameters follow
             cvvp_amount=.0,
             # diffusion generation parameters follow
             diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
-            use_stt_check=False,
+            diffusion_sampler='p_sample', ddim_eta=0.0, adaptive_diffusion_tolerance=None,
+            diffusion_window=None, diffusion_window_overlap=32,
+            use_stt_check=False, qa_policy=None,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -359,6 +590,19 @@ class TextToSpeech:
                                    of long silences or "uhhhhhhs", etc.
         :param top_p: P value used in nucleus sampling. (0,1]. Lower values mean the decoder produces more "likely" (aka boring) outputs.
         :param max_mel_tokens: Restricts the output length. (0,600] integer. Each unit is 1/20 of a second.
+        :param keep_autoregressive_latents: When true, the latents produced while sampling are kept for the best candidates,
+                                            which avoids running the autoregressive model a second time to re-produce them.
+                                            Candidates are scored as they are sampled, so CLVP stays on the device alongside
+                                            the autoregressive model. Default is false.
+        :param latent_memory_budget_gb: How much memory (in GB) kept latents may use before they are spilled to disk.
+        :param adaptive_sampling: When true, every batch of autoregressive samples is scored as soon as it is generated and
+                                  sampling stops early once the k best candidates are good enough (see below).
+                                  num_autoregressive_samples becomes the maximum number of samples. Default is false.
+        :param min_autoregressive_samples: The minimum number of samples taken when adaptive_sampling is set.
+        :param clvp_score_threshold: When adaptive_sampling is set, sampling stops once all of the k best candidates have
+                                     at least this score. If omitted, only clvp_patience is used.
+        :param clvp_patience: When adaptive_sampling is set, sampling stops once this many consecutive batches have not
+                              improved the score of the k-th best candidate.
         :param typical_sampling: Turns typical sampling on or off. This sampling mode is discussed in this paper: https://arxiv.org/abs/2202.00666
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
@@ -379,7 +623,26 @@ class TextToSpeech:
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param diffusion_sampler: How to sample from the diffusion model. 'p_sample' (the default) is the ancestral sampler
+                                  the model was trained with. 'ddim' uses DDIM, which produces comparable output with far
+                                  fewer diffusion_iterations. 'dpm_solver' uses the DPM-Solver++ ODE solver, which needs
+                                  only 10-20 diffusion_iterations.
+        :param ddim_eta: How much noise DDIM adds at every step. [0,1]. 0 is deterministic DDIM and 1 is close to
+                         ancestral sampling. Only used when diffusion_sampler='ddim'.
+        :param adaptive_diffusion_tolerance: When given, each clip stops being diffused once its predicted spectrogram
+                                             changes by less than this fraction between two steps, and diffusion stops
+                                             once every clip has converged. diffusion_iterations becomes the maximum
+                                             number of steps. The steps each clip took are stored in diffusion_steps.
+                                             Values around 1e-3 are a reasonable start. Default is None (off).
+        :param diffusion_window: When given, spectrograms longer than this many frames (~94 per second) are diffused as
+                                 a batch of overlapping windows that are crossfaded together, so memory use grows
+                                 linearly with the length of the clip rather than quadratically. Default is None (off).
+        :param diffusion_window_overlap: Minimum number of frames that neighbouring diffusion windows share.
         ~~OTHER STUFF~~
+        :param use_stt_check: When true, candidates are transcribed with whisper and the first one which passes
+                              qa_policy is returned.
+        :param qa_policy: The QAPolicy candidates must pass when use_stt_check is set. Defaults to QAPolicy(), which
+                          only rejects transcripts with several extra words.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -387,11 +650,265 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        self.diffusion_steps = []
+
+        text_tokens = self.get_text_tokens(text)
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning(voice_samples, conditioning_latents)
 
-        text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
-        text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
-        assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+        diffuser = self.load_diffuser(diffusion_iterations, cond_free, cond_free_k, diffusion_sampler)
 
+        with torch.no_grad():
+            best_results, best_latents = self.generate_autoregressive_candidates(
+                text_tokens, auto_conditioning, auto_conds, k=k, verbose=verbose,
+                num_autoregressive_samples=num_autoregressive_samples, temperature=temperature,
+                length_penalty=length_penalty, repetition_penalty=repetition_penalty, top_p=top_p,
+                max_mel_tokens=max_mel_tokens, keep_autoregressive_latents=keep_autoregressive_latents,
+                latent_memory_budget_gb=latent_memory_budget_gb, adaptive_sampling=adaptive_sampling,
+                min_autoregressive_samples=min_autoregressive_samples, clvp_score_threshold=clvp_score_threshold,
+                clvp_patience=clvp_patience, cvvp_amount=cvvp_amount, **hf_generate_kwargs)
+            del auto_conditioning
+
+            if verbose:
+                print("Transforming autoregressive outputs into audio..")
+            latents = [trim_latents_at_silence(best_results[b].unsqueeze(0), best_latents[b].unsqueeze(0))
+                       for b in range(best_results.shape[0])]
+            # With the STT check, candidates are only diffused until one of them passes.
+            wavs = self.iter_latents_to_audio(latents, diffuser, diffusion_conditioning,
+                                              temperature=diffusion_temperature, verbose=verbose,
+                                              sampler=diffusion_sampler, ddim_eta=ddim_eta,
+                                              adaptive_tolerance=adaptive_diffusion_tolerance, window=diffusion_window,
+                                              window_overlap=diffusion_window_overlap, grow_chunks=use_stt_check)
+            try:
+                res, stt_results = self.select_candidates(text, wavs, use_stt_check=use_stt_check, qa_policy=qa_policy)
+            finally:
+                wavs.close()
+            if return_deterministic_state:
+                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
+            else:
+                return res, stt_results
+
+    def tts_batch(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+                  **kwargs):
+        """
+        Produces audio clips of several texts being spoken with the same reference voice. Conditioning is computed once,
+        and up to autoregressive_batch_size texts are sampled from the autoregressive model and diffused together, which
+        keeps the device busy when the texts are short. See iter_tts_batch() for the parameters.
+        :return: A tuple of (clips, stt_results), which are lists with one entry per text. Each entry is the same as
+                 returned by tts() for that text.
+        """
+        clips = []
+        stt_results = []
+        for clip, stt_result in self.iter_tts_batch(texts, voice_samples=voice_samples,
+                                                    conditioning_latents=conditioning_latents, k=k, verbose=verbose,
+                                                    use_deterministic_seed=use_deterministic_seed, **kwargs):
+            clips.append(clip)
+            stt_results.append(stt_result)
+        return clips, stt_results
+
+    def iter_tts_batch(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+                       # autoregressive generation parameters follow
+                       num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+                       # CVVP parameters follow
+                       cvvp_amount=.0,
+                       # diffusion generation parameters follow
+                       diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+                       diffusion_sampler='p_sample', ddim_eta=0.0, adaptive_diffusion_tolerance=None,
+                       diffusion_window=None, diffusion_window_overlap=32,
+                       use_stt_check=False, qa_policy=None,
+                       **hf_generate_kwargs):
+        """
+        Generator form of tts_batch(). Texts are generated in groups of up to autoregressive_batch_size, and the results
+        of each group are yielded as soon as it is done, so callers can save them before the next group starts and only
+        one group is held in memory.
+        The random seed is re-applied at the start of every group, so a group of texts is reproduced by running it again
+        with the same seed. A group holding a single text samples the same candidates as tts() would.
+        :param texts: List of texts to be spoken.
+        All other parameters are the same as tts(). return_deterministic_state and the options which score candidates
+        while sampling (keep_autoregressive_latents, adaptive_sampling and their settings) are not supported.
+        :return: A generator over (clip, stt_result) tuples, one per text and in the same order as texts. Each is the
+                 same as returned by tts() for that text.
+        """
+        reject_unsupported_kwargs('tts_batch', hf_generate_kwargs,
+                                  ('return_deterministic_state', 'keep_autoregressive_latents', 'latent_memory_budget_gb',
+                                   'adaptive_sampling', 'min_autoregressive_samples', 'clvp_score_threshold',
+                                   'clvp_patience'))
+        seed = self.deterministic_state(seed=use_deterministic_seed)
+        self.diffusion_steps = []
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning(voice_samples, conditioning_latents)
+        diffuser = self.load_diffuser(diffusion_iterations, cond_free, cond_free_k, diffusion_sampler)
+
+        with torch.no_grad():
+            for start in range(0, len(texts), self.autoregressive_batch_size):
+                group = texts[start:start + self.autoregressive_batch_size]
+                self.deterministic_state(seed=seed)
+                text_tokens = self.get_text_tokens_batch(group)
+                best_results, best_latents = self.generate_autoregressive_candidates_batch(
+                    text_tokens, auto_conditioning, auto_conds, k=k, verbose=verbose,
+                    num_autoregressive_samples=num_autoregressive_samples, temperature=temperature,
+                    length_penalty=length_penalty, repetition_penalty=repetition_penalty, top_p=top_p,
+                    max_mel_tokens=max_mel_tokens, cvvp_amount=cvvp_amount, **hf_generate_kwargs)
+
+                if verbose:
+                    print("Transforming autoregressive outputs into audio..")
+                latents = [trim_latents_at_silence(best_results[b].unsqueeze(0), best_latents[b].unsqueeze(0))
+                           for b in range(best_results.shape[0])]
+                del best_results, best_latents
+                diffusion_kwargs = dict(temperature=diffusion_temperature, verbose=verbose, sampler=diffusion_sampler,
+                                        ddim_eta=ddim_eta, adaptive_tolerance=adaptive_diffusion_tolerance,
+                                        window=diffusion_window, window_overlap=diffusion_window_overlap)
+                if not use_stt_check:
+                    # Every text's candidates are needed, so they are diffused in batches across the whole group.
+                    wavs = list(self.iter_latents_to_audio(latents, diffuser, diffusion_conditioning, **diffusion_kwargs))
+                    del latents
+                    for i, text in enumerate(group):
+                        yield self.select_candidates(text, wavs[i * k:(i + 1) * k], qa_policy=qa_policy)
+                    continue
+
+                # With the STT check, each text's candidates are only diffused until one of them passes.
+                for i, text in enumerate(group):
+                    wavs = self.iter_latents_to_audio(latents[i * k:(i + 1) * k], diffuser, diffusion_conditioning,
+                                                      grow_chunks=True, **diffusion_kwargs)
+                    try:
+                        result = self.select_candidates(text, wavs, use_stt_check=True, qa_policy=qa_policy)
+                    finally:
+                        wavs.close()
+                    yield result
+
+    def latents_to_audio(self, latents, diffuser, diffusion_conditioning, temperature=1, verbose=True, sampler='p_sample',
+                         ddim_eta=0.0, adaptive_tolerance=None, window=None, window_overlap=32):
+        """
+        Converts a list of (1,s,d) autoregressive latents into a list of (1,1,samples) 24kHz clips. The latents are
+        padded to a common length so that they are diffused and vocoded as a single batch, and each clip is trimmed
+        back to its own length afterwards. The diffusion model and vocoder must already have been acquired.
+        The number of diffusion steps taken by each clip is appended to diffusion_steps.
+        """
+        lengths = [latent.shape[1] for latent in latents]
+        padded = torch.stack([pad_latent(latent[0], max(lengths)) for latent in latents])
+        mel, num_steps = do_spectrogram_diffusion(self.diffusion, diffuser, padded, diffusion_conditioning,
+                                                  temperature=temperature, verbose=verbose,
+                                                  timestep_embeddings=self.get_timestep_embeddings(diffuser),
+                                                  sampler=sampler, ddim_eta=ddim_eta,
+                                                  adaptive_tolerance=adaptive_tolerance, window=window,
+                                                  window_overlap=window_overlap, return_num_steps=True)
+        self.diffusion_steps.extend(num_steps)
+        if verbose and adaptive_tolerance is not None:
+            print(f"Diffusion took {', '.join(str(n) for n in num_steps)} of {diffuser.num_timesteps} steps.")
+        mel_lengths = [spectrogram_length(length) for length in lengths]
+        for b, mel_length in enumerate(mel_lengths):
+            # Silence out the padding so that it does not bleed into the end of shorter clips once vocoded.
+            mel[b, :, mel_length:] = -11.5129
+        wav = self.vocoder.inference(mel)
+        return [wav[b:b+1, :, :mel_length * self.vocoder.hop_length] for b, mel_length in enumerate(mel_lengths)]
+
+    def iter_latents_to_audio(self, latents, diffuser, diffusion_conditioning, grow_chunks=False, **kwargs):
+        """
+        Converts latents with latents_to_audio() in batches of up to autoregressive_batch_size, yielding the clips one
+        by one. The diffusion model and vocoder are acquired while the generator runs. With grow_chunks, the first batch
+        holds a single latent and each one after it twice as many, so a caller which stops after the first few clips
+        does not pay for diffusing the rest.
+        """
+        chunk_size = 1 if grow_chunks else self.autoregressive_batch_size
+        with self.residency.use(self, 'diffusion'), self.residency.use(self, 'vocoder'):
+            start = 0
+            while start < len(latents):
+                wavs = self.latents_to_audio(latents[start:start + chunk_size], diffuser, diffusion_conditioning, **kwargs)
+                start += chunk_size
+                chunk_size = min(chunk_size * 2, self.autoregressive_batch_size)
+                yield from wavs
+
+    def load_diffuser(self, diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_sampler='p_sample'):
+        """
+        Returns the (cached) diffuser for the given diffusion settings. See tts() for a description of the parameters.
+        """
+        return load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free,
+                                              cond_free_k=cond_free_k, fuse_cond_free=self.fuse_cond_free,
+                                              log_snr_spacing=diffusion_sampler == 'dpm_solver')
+
+    def get_timestep_embeddings(self, diffuser):
+        """
+        Returns the diffusion model's embeddings of every timestep used by the given diffuser, computed once per
+        schedule and device. Like the diffusers themselves, only the DIFFUSER_CACHE_SIZE most recently used are kept.
+        The diffusion model must already have been acquired.
+        """
+        if not hasattr(self.diffusion, 'precompute_timestep_embeddings'):
+            return None  # Traced models compute timestep embeddings themselves.
+        device = next(self.diffusion.parameters()).device
+        key = (tuple(diffuser.timestep_map), device)
+        if key in self.timestep_embeddings:
+            self.timestep_embeddings.move_to_end(key)
+        else:
+            with torch.no_grad():
+                timesteps = torch.tensor(diffuser.timestep_map, device=device)
+                self.timestep_embeddings[key] = self.diffusion.precompute_timestep_embeddings(timesteps)
+            while len(self.timestep_embeddings) > DIFFUSER_CACHE_SIZE:
+                self.timestep_embeddings.popitem(last=False)
+        return self.timestep_embeddings[key]
+
+    def select_candidates(self, text, wav_candidates, use_stt_check=False, qa_policy=None):
+        """
+        Picks the clips to return out of the candidates generated for `text`, as done at the end of tts(). With
+        use_stt_check, the first candidate whose transcription passes qa_policy is returned, or the first candidate if
+        none do. wav_candidates may be a generator, which is not advanced past the candidate that passes. The QA scores
+        of the last transcription are stored in stt_results['qa']. Clips are redacted if enable_redaction is set, all in
+        a single wav2vec2 batch.
+        :return: A tuple of (clips, stt_results) in the same format as tts().
+        """
+        stt_results = None
+        if use_stt_check:
+            if self.stt is None:
+                self.stt = whisper.load_model("large-v2")
+            qa_policy = QAPolicy() if qa_policy is None else qa_policy
+            selected = None
+            with self.residency.use(self, 'stt'):
+                for wav in wav_candidates:
+                    if selected is None:
+                        selected = [wav]
+                    stt_results = self.stt.transcribe(torch.flatten(wav))
+                    transcribed_text = stt_results['text'].strip()
+                    stt_results['qa'] = qa_policy.check([text], [transcribed_text])[0]
+                    print(f"STT: {transcribed_text} (WER {stt_results['qa']['wer']:.2f})")
+                    if stt_results['qa']['passed']:
+                        stt_results['passed'] = True
+                        selected = [wav]
+                        break
+            wav_candidates = selected
+        else:
+            wav_candidates = list(wav_candidates)
+
+        if self.enable_redaction:
+            wav_candidates = self.aligner.redact_batch([wav_candidate.squeeze(1) for wav_candidate in wav_candidates],
+                                                       [text] * len(wav_candidates))
+            wav_candidates = [wav_candidate.unsqueeze(1) for wav_candidate in wav_candidates]
+
+        if len(wav_candidates) > 1:
+            return wav_candidates, stt_results
+        return wav_candidates[0], stt_results
+
+    def get_text_tokens(self, text):
+        """
+        Tokenizes the given text into the (1,t) tensor expected by the autoregressive model and CLVP.
+        """
+        return self.get_text_tokens_batch([text])[0]
+
+    def get_text_tokens_batch(self, texts):
+        """
+        Like get_text_tokens(), but tokenizes a list of texts together. Returns a list of (1,t) tensors.
+        """
+        all_text_tokens = []
+        for ids in self.tokenizer.encode_batch(texts):
+            text_tokens = torch.IntTensor(ids).unsqueeze(0).to(self.device)
+            text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
+            assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+            all_text_tokens.append(text_tokens)
+        return all_text_tokens
+
+    def resolve_conditioning(self, voice_samples=None, conditioning_latents=None):
+        """
+        Produces the conditioning inputs for generation from either voice_samples, conditioning_latents or a random voice,
+        in that order of preference.
+        :return: A tuple of (autoregressive_conditioning_latent, diffusion_conditioning_latent, autoregressive_conditioning_mels).
+                 The MELs are only available when voice_samples are provided and are None otherwise.
+        """
         auto_conds = None
         if voice_samples is not None:
             auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
@@ -401,137 +918,278 @@ class TextToSpeech:
             auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
         auto_conditioning = auto_conditioning.to(self.device)
         diffusion_conditioning = diffusion_conditioning.to(self.device)
+        return auto_conditioning, diffusion_conditioning, auto_conds
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
-
-        with torch.no_grad():
+    def generate_autoregressive_candidates(self, text_tokens, auto_conditioning, auto_conds=None, k=1, verbose=True,
+                                           num_autoregressive_samples=512, temperature=.8, length_penalty=1,
+                                           repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+                                           keep_autoregressive_latents=False, latent_memory_budget_gb=1.0,
+                                           adaptive_sampling=False, min_autoregressive_samples=32, clvp_score_threshold=None,
+                                           clvp_patience=2, cvvp_amount=.0, **hf_generate_kwargs):
+        """
+        Samples MEL codes for the given text tokens from the autoregressive model, picks the k best using CLVP (and
+        CVVP) and returns them along with the autoregressive latents the diffusion model is conditioned on.
+        See tts() for a description of the parameters.
+        :return: A tuple of (codes, latents), shaped (k,s) and (k,s,d).
+        """
+        with torch.no_grad(), ExitStack() as scoring:
             samples = []
+            clip_results = []
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             stop_mel_token = self.autoregressive.stop_mel_token
-            calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
-            self.autoregressive = self.autoregressive.to(self.device)
-            if verbose:
-                print("Generating autoregressive samples..")
-            for b in tqdm(range(num_batches), disable=not verbose):
-                codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                             do_sample=True,
-                                                             top_p=top_p,
-                                                             temperature=temperature,
-                                                             num_return_sequences=self.autoregressive_batch_size,
-                                                             length_penalty=length_penalty,
-                                                             repetition_penalty=repetition_penalty,
-                                                             max_generate_length=max_mel_tokens,
-                                                             **hf_generate_kwargs)
-                padding_needed = max_mel_tokens - codes.shape[1]
-                codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                samples.append(codes)
-            self.autoregressive = self.autoregressive.cpu()
+            latent_store = None
+            if keep_autoregressive_latents:
+                # Candidates are scored as soon as they are sampled, so that the latents of candidates which can no
+                # longer make it into the top k are dropped straight away.
+                latent_store = LatentStore(memory_budget=int(latent_memory_budget_gb * (1024 ** 3)))
+            score_while_sampling = keep_autoregressive_latents or adaptive_sampling
+            if score_while_sampling:
+                scoring.enter_context(self.scoring_models(cvvp_amount, verbose))
+            best_kth_score = None
+            batches_without_improvement = 0
+            with self.residency.use(self, 'autoregressive'):
+                if verbose:
+                    print("Generating autoregressive samples..")
+                # The conditioning+text prefix is identical for every batch, so it only needs to go through the model once.
+                speech_prefix = self.autoregressive.get_speech_prefix(auto_conditioning, text_tokens)
+                for b in tqdm(range(num_batches), disable=not verbose):
+                    codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                 speech_prefix=speech_prefix,
+                                                                 return_latent=latent_store is not None,
+                                                                 do_sample=True,
+                                                                 top_p=top_p,
+                                                                 temperature=temperature,
+                                                                 num_return_sequences=self.autoregressive_batch_size,
+                                                                 length_penalty=length_penalty,
+                                                                 repetition_penalty=repetition_penalty,
+                                                                 max_generate_length=max_mel_tokens,
+                                                                 **hf_generate_kwargs)
+                    if latent_store is not None:
+                        codes, latents = codes
+                    padding_needed = max_mel_tokens - codes.shape[1]
+                    codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                    samples.append(codes)
+                    if score_while_sampling:
+                        clip_results.append(self.score_candidates(text_tokens, codes, auto_conds, cvvp_amount))
+                        scores = torch.cat(clip_results, dim=0)
+                        top_k = torch.topk(scores, k=min(k, scores.shape[0]))
+                        if latent_store is not None:
+                            for i in range(latents.shape[0]):
+                                latent_store.add(b * self.autoregressive_batch_size + i, latents[i])
+                            latent_store.keep_only(top_k.indices.tolist())
+                        if adaptive_sampling and scores.shape[0] >= k:
+                            kth_score = top_k.values[-1].item()
+                            if best_kth_score is not None and kth_score <= best_kth_score:
+                                batches_without_improvement += 1
+                            else:
+                                batches_without_improvement = 0
+                                best_kth_score = kth_score
+                            if scores.shape[0] >= min_autoregressive_samples and (
+                                    batches_without_improvement >= clvp_patience or
+                                    (clvp_score_threshold is not None and kth_score >= clvp_score_threshold)):
+                                if verbose:
+                                    print(f"Stopping early after {scores.shape[0]} of {num_batches * self.autoregressive_batch_size} autoregressive samples.")
+                                break
 
-            clip_results = []
-            self.clvp = self.clvp.to(self.device)
-            if cvvp_amount > 0:
-                if self.cvvp is None:
-                    self.load_cvvp()
-                self.cvvp = self.cvvp.to(self.device)
-            if verbose:
-                if self.cvvp is None:
-                    print("Computing best candidates using CLVP")
-                else:
-                    print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-            for batch in tqdm(samples, disable=not verbose):
-                for i in range(batch.shape[0]):
-                    batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                if cvvp_amount != 1:
-                    clvp = self.clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                if auto_conds is not None and cvvp_amount > 0:
-                    cvvp_accumulator = 0
-                    for cl in range(auto_conds.shape[1]):
-                        cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                    cvvp = cvvp_accumulator / auto_conds.shape[1]
-                    if cvvp_amount == 1:
-                        clip_results.append(cvvp)
-                    else:
-                        clip_results.append(cvvp * cvvp_amount + clvp * (1-cvvp_amount))
-                else:
-                    clip_results.append(clvp)
+            if not score_while_sampling:
+                scoring.enter_context(self.scoring_models(cvvp_amount, verbose))
+                for batch in tqdm(samples, disable=not verbose):
+                    clip_results.append(self.score_candidates(text_tokens, batch, auto_conds, cvvp_amount))
+            scoring.close()
             clip_results = torch.cat(clip_results, dim=0)
             samples = torch.cat(samples, dim=0)
-            best_results = samples[torch.topk(clip_results, k=k).indices]
-            self.clvp = self.clvp.cpu()
-            if self.cvvp is not None:
-                self.cvvp = self.cvvp.cpu()
+            best_indices = torch.topk(clip_results, k=k).indices
+            best_results = samples[best_indices]
             del samples
 
-            # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            self.autoregressive = self.autoregressive.to(self.device)
-            best_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                               torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                               torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                               return_latent=True, clip_inputs=False)
-            self.autoregressive = self.autoregressive.cpu()
-            del auto_conditioning
+            if latent_store is not None and all(i in latent_store for i in best_indices.tolist()):
+                best_latents = torch.stack([pad_latent(latent_store.get(i), best_results.shape[-1])
+                                            for i in best_indices.tolist()], dim=0)
+            else:
+                # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
+                # inputs. Re-produce those for the top results. Pass keep_autoregressive_latents=True to keep them from
+                # sampling instead, at the cost of some extra memory.
+                with self.residency.use(self, 'autoregressive'):
+                    best_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                       torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                       torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                       return_latent=True, clip_inputs=False)
+            if latent_store is not None:
+                latent_store.close()
 
-            if verbose:
-                print("Transforming autoregressive outputs into audio..")
-            wav_candidates = []
-            stt_results = None
-            if use_stt_check and self.stt is None:
-                self.stt = whisper.load_model("large-v2")
+            return best_results, best_latents
 
-            if use_stt_check:
-                self.stt = self.stt.to(self.device)
-            self.diffusion = self.diffusion.to(self.device)
-            self.vocoder = self.vocoder.to(self.device)
-            for b in range(best_results.shape[0]):
-                codes = best_results[b].unsqueeze(0)
-                latents = best_latents[b].unsqueeze(0)
-
-                # Find the first occurrence of the "calm" token and trim the codes to that.
-                ctokens = 0
-                for k in range(codes.shape[-1]):
-                    if codes[0, k] == calm_token:
-                        ctokens += 1
-                    else:
-                        ctokens = 0
-                    if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                        latents = latents[:, :k]
-                        break
+    def generate_autoregressive_candidates_batch(self, text_tokens, auto_conditioning, auto_conds=None, k=1, verbose=True,
+                                                 num_autoregressive_samples=512, temperature=.8, length_penalty=1,
+                                                 repetition_penalty=2.0, top_p=.8, max_mel_tokens=500, cvvp_amount=.0,
+                                                 **hf_generate_kwargs):
+        """
+        Like generate_autoregressive_candidates(), but for a list of (1,t) text tokens which share the same conditioning.
+        The text tokens are zero-padded to a common length (as they were in training) so that every batch sampled from
+        the autoregressive model holds candidates for all of the texts. Candidates are scored against their own
+        unpadded text.
+        :return: A tuple of (codes, latents), shaped (n*k,s) and (n*k,s,d), holding the k best candidates of each text
+                 in turn.
+        """
+        with torch.no_grad():
+            num_texts = len(text_tokens)
+            max_text_len = max(tokens.shape[-1] for tokens in text_tokens)
+            padded_text_tokens = torch.cat([F.pad(tokens, (0, max_text_len - tokens.shape[-1])) for tokens in text_tokens], dim=0)
+            samples_per_text = max(1, min(num_autoregressive_samples, self.autoregressive_batch_size // num_texts))
+            num_batches = max(1, num_autoregressive_samples // samples_per_text)
+            stop_mel_token = self.autoregressive.stop_mel_token
 
-                mel = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning,
-                                               temperature=diffusion_temperature, verbose=verbose)
-                wav = self.vocoder.inference(mel)
-                wav_candidates.append(wav)
-                if use_stt_check:
-                    stt_results = self.stt.transcribe(torch.flatten(wav))
-                    transcribed_text = stt_results['text'].strip()
-                    print(f"STT: {transcribed_text}")
-                    if check_texts_approx_match(text, transcribed_text):
-                        stt_results['passed'] = True
-                        break
+            samples = []
+            with self.residency.use(self, 'autoregressive'):
+                if verbose:
+                    print(f"Generating autoregressive samples for {num_texts} texts..")
+                speech_prefix = self.autoregressive.get_speech_prefix(auto_conditioning, padded_text_tokens)
+                for b in tqdm(range(num_batches), disable=not verbose):
+                    codes = self.autoregressive.inference_speech(auto_conditioning, padded_text_tokens,
+                                                                 speech_prefix=speech_prefix,
+                                                                 do_sample=True,
+                                                                 top_p=top_p,
+                                                                 temperature=temperature,
+                                                                 num_return_sequences=samples_per_text,
+                                                                 length_penalty=length_penalty,
+                                                                 repetition_penalty=repetition_penalty,
+                                                                 max_generate_length=max_mel_tokens,
+                                                                 **hf_generate_kwargs)
+                    padding_needed = max_mel_tokens - codes.shape[1]
+                    codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                    # Samples for each text are contiguous in the generated batch.
+                    samples.append(codes.view(num_texts, samples_per_text, -1))
+            samples = torch.cat(samples, dim=1)
 
-            if use_stt_check:
-                wav_candidates = wav_candidates[-1:] if 'passed' in stt_results and stt_results['passed'] else wav_candidates[:1]
-                self.stt = self.stt.cpu()
-            self.diffusion = self.diffusion.cpu()
-            self.vocoder = self.vocoder.cpu()
+            best_results = []
+            with self.scoring_models(cvvp_amount, verbose):
+                for i in tqdm(range(num_texts), disable=not verbose):
+                    clip_results = torch.cat([self.score_candidates(text_tokens[i], batch, auto_conds, cvvp_amount)
+                                              for batch in samples[i].split(self.autoregressive_batch_size)], dim=0)
+                    best_results.append(samples[i][torch.topk(clip_results, k=k).indices])
+            best_results = torch.cat(best_results, dim=0)
+            del samples
 
-            def potentially_redact(clip, text):
-                if self.enable_redaction:
-                    return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
-                return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+            # Re-produce the latents the diffusion model is conditioned on, using the same padded text the codes were
+            # sampled with.
+            with self.residency.use(self, 'autoregressive'):
+                padded_text_tokens = padded_text_tokens.repeat_interleave(k, 0)
+                best_latents = []
+                for b in range(0, best_results.shape[0], self.autoregressive_batch_size):
+                    codes = best_results[b:b + self.autoregressive_batch_size]
+                    best_latents.append(self.autoregressive(auto_conditioning.repeat(codes.shape[0], 1),
+                                                            padded_text_tokens[b:b + self.autoregressive_batch_size],
+                                                            torch.tensor([max_text_len], device=codes.device), codes,
+                                                            torch.tensor([codes.shape[-1]*self.autoregressive.mel_length_compression], device=codes.device),
+                                                            return_latent=True, clip_inputs=False))
 
-            if len(wav_candidates) > 1:
-                res = wav_candidates
-            else:
-                res = wav_candidates[0]
+            return best_results, torch.cat(best_latents, dim=0)
 
-            if return_deterministic_state:
-                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
-            else:
-                return res, stt_results
+    def tts_stream(self, text, voice_samples=None, conditioning_latents=None, verbose=True, use_deterministic_seed=None,
+                   split_text=True, vocoder_window=100,
+                   # autoregressive generation parameters follow
+                   num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8,
+                   max_mel_tokens=500, keep_autoregressive_latents=False, latent_memory_budget_gb=1.0,
+                   adaptive_sampling=False, min_autoregressive_samples=32, clvp_score_threshold=None, clvp_patience=2,
+                   # CVVP parameters follow
+                   cvvp_amount=.0,
+                   # diffusion generation parameters follow
+                   diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+                   diffusion_sampler='p_sample', ddim_eta=0.0, adaptive_diffusion_tolerance=None,
+                   diffusion_window=None, diffusion_window_overlap=32,
+                   **hf_generate_kwargs):
+        """
+        Like tts(), but yields audio as soon as each piece of it is ready rather than returning the whole clip at the end.
+        Long text is split into segments which are generated one after the other, and the spectrogram of each segment is
+        vocoded and yielded in windows of `vocoder_window` frames. Only the best candidate is produced. Segments which
+        need to be redacted (see enable_redaction) are yielded whole.
+        :param split_text: Whether or not to split the text into segments using split_and_recombine_text(). Default is true.
+                           Segments are split off as they are needed, so long text does not have to be split up front.
+        :param vocoder_window: Number of MEL frames vocoded per yielded chunk. Each frame is 256 samples at 24kHz.
+        All other parameters are the same as tts(). k, use_stt_check, qa_policy and return_deterministic_state are not
+        supported, since only one candidate is produced and it is yielded before the whole clip exists.
+        :return: A generator over (1,S) torch tensors of audio. Sample rate is 24kHz.
+        """
+        reject_unsupported_kwargs('tts_stream', hf_generate_kwargs,
+                                  ('k', 'use_stt_check', 'qa_policy', 'return_deterministic_state'))
+        self.deterministic_state(seed=use_deterministic_seed)
+        self.diffusion_steps = []
+        texts = iter_split_and_recombine_text(text) if split_text else [text]
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning(voice_samples, conditioning_latents)
+        diffuser = self.load_diffuser(diffusion_iterations, cond_free, cond_free_k, diffusion_sampler)
+
+        with torch.no_grad():
+            for segment in texts:
+                text_tokens = self.get_text_tokens(segment)
+                best_results, best_latents = self.generate_autoregressive_candidates(
+                    text_tokens, auto_conditioning, auto_conds, k=1, verbose=verbose,
+                    num_autoregressive_samples=num_autoregressive_samples, temperature=temperature,
+                    length_penalty=length_penalty, repetition_penalty=repetition_penalty, top_p=top_p,
+                    max_mel_tokens=max_mel_tokens, keep_autoregressive_latents=keep_autoregressive_latents,
+                    latent_memory_budget_gb=latent_memory_budget_gb, adaptive_sampling=adaptive_sampling,
+                    min_autoregressive_samples=min_autoregressive_samples, clvp_score_threshold=clvp_score_threshold,
+                    clvp_patience=clvp_patience, cvvp_amount=cvvp_amount, **hf_generate_kwargs)
+                latents = trim_latents_at_silence(best_results, best_latents)
+
+                with self.residency.use(self, 'diffusion'):
+                    mel, num_steps = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning,
+                                                              temperature=diffusion_temperature, verbose=verbose,
+                                                              timestep_embeddings=self.get_timestep_embeddings(diffuser),
+                                                              sampler=diffusion_sampler, ddim_eta=ddim_eta,
+                                                              adaptive_tolerance=adaptive_diffusion_tolerance,
+                                                              window=diffusion_window,
+                                                              window_overlap=diffusion_window_overlap,
+                                                              return_num_steps=True)
+                self.diffusion_steps.extend(num_steps)
+                if verbose and adaptive_diffusion_tolerance is not None:
+                    print(f"Diffusion took {num_steps[0]} of {diffuser.num_timesteps} steps.")
+
+                with self.residency.use(self, 'vocoder'):
+                    if self.enable_redaction and '[' in segment:
+                        wav = self.vocoder.inference(mel)
+                        yield self.aligner.redact(wav.squeeze(1), segment)
+                    else:
+                        for wav in self.vocoder.inference_windows(mel, window=vocoder_window):
+                            yield wav.squeeze(1)
+
+    @contextmanager
+    def scoring_models(self, cvvp_amount=.0, verbose=True):
+        """
+        Keeps the models used by score_candidates() on the device for the duration of a with block.
+        """
+        with ExitStack() as stack:
+            stack.enter_context(self.residency.use(self, 'clvp'))
+            if cvvp_amount > 0:
+                if self.cvvp is None:
+                    self.load_cvvp()
+                stack.enter_context(self.residency.use(self, 'cvvp'))
+            if verbose:
+                if self.cvvp is None:
+                    print("Computing best candidates using CLVP")
+                else:
+                    print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+            yield
+
+    def score_candidates(self, text_tokens, codes, auto_conds=None, cvvp_amount=.0):
+        """
+        Fixes up a batch of autoregressive codes in place (see fix_autoregressive_output) and scores how well each of
+        them matches the text using CLVP, blended with CVVP if cvvp_amount > 0. Higher is better.
+        The scoring models must be on the device; see scoring_models().
+        """
+        stop_mel_token = self.autoregressive.stop_mel_token
+        for i in range(codes.shape[0]):
+            codes[i] = fix_autoregressive_output(codes[i], stop_mel_token)
+        if cvvp_amount != 1:
+            clvp = self.clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+        if auto_conds is not None and cvvp_amount > 0:
+            cvvp_accumulator = 0
+            for cl in range(auto_conds.shape[1]):
+                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(codes.shape[0], 1, 1), codes, return_loss=False)
+            cvvp = cvvp_accumulator / auto_conds.shape[1]
+            if cvvp_amount == 1:
+                return cvvp
+            return cvvp * cvvp_amount + clvp * (1-cvvp_amount)
+        return clvp
 
     def deterministic_state(self, seed=None):
         """
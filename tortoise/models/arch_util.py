@@ -329,6 +329,19 @@ class TorchMelSpectrogram(nn.Module):
         return mel
 
 
+@functools.lru_cache(maxsize=None)
+def _get_torch_mel_spectrogram(device, kwargs):
+    return TorchMelSpectrogram(**dict(kwargs)).to(device)
+
+
+def get_torch_mel_spectrogram(device='cpu', **kwargs):
+    """
+    Returns a TorchMelSpectrogram with the given parameters on the given device. Instances are shared between calls, so
+    the filterbank is built and the MEL norms are loaded from disk only once per set of parameters and device.
+    """
+    return _get_torch_mel_spectrogram(torch.device(device), tuple(sorted(kwargs.items())))
+
+
 class CheckpointedLayer(nn.Module):
     """
     Wraps a module. When forward() is called, passes kwargs that require_grad through torch.checkpoint() and bypasses
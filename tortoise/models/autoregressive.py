@@ -44,6 +44,8 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        self.cached_prefix_past = None
+        self.recorded_latents = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -72,6 +74,25 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def store_prefix_past(self, prefix_past):
+        """
+        Stores the transformer key/values for cached_mel_emb, so the first generation step only needs to process the
+        tokens that follow it. Set to None to run the full prefix through the transformer instead.
+        """
+        self.cached_prefix_past = prefix_past
+
+    def start_recording_latents(self):
+        """
+        Starts recording the final (normalized) hidden state of every token processed by forward(). These correspond to
+        the latents that UnifiedVoice.forward() produces with return_latent=True.
+        """
+        self.recorded_latents = []
+
+    def stop_recording_latents(self):
+        latents = torch.cat(self.recorded_latents, dim=1)
+        self.recorded_latents = None
+        return latents
+
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
 
         token_type_ids = kwargs.get("token_type_ids", None)
@@ -129,11 +150,21 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             text_inputs = input_ids[:, mel_len:]
             text_emb = self.embeddings(text_inputs)
             text_emb = text_emb + self.text_pos_embedding(text_emb)
-            if self.cached_mel_emb.shape[0] != text_emb.shape[0]:
-                mel_emb = self.cached_mel_emb.repeat_interleave(text_emb.shape[0]//self.cached_mel_emb.shape[0], 0)
+            if self.cached_prefix_past is not None and past_key_values is None:
+                # The prefix has already been run through the transformer, so only the tokens after it are processed.
+                past_key_values = tuple(
+                    tuple(past_state.repeat_interleave(text_emb.shape[0]//past_state.shape[0], 0) for past_state in layer_past)
+                    for layer_past in self.cached_prefix_past
+                )
+                if position_ids is not None:
+                    position_ids = position_ids[:, mel_len:]
+                emb = text_emb
             else:
-                mel_emb = self.cached_mel_emb
-            emb = torch.cat([mel_emb, text_emb], dim=1)
+                if self.cached_mel_emb.shape[0] != text_emb.shape[0]:
+                    mel_emb = self.cached_mel_emb.repeat_interleave(text_emb.shape[0]//self.cached_mel_emb.shape[0], 0)
+                else:
+                    mel_emb = self.cached_mel_emb
+                emb = torch.cat([mel_emb, text_emb], dim=1)
         else:
             emb = self.embeddings(input_ids)
             emb = emb + self.text_pos_embedding.get_fixed_embedding(attention_mask.shape[1]-mel_len, attention_mask.device)
@@ -159,6 +190,10 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
+        if self.recorded_latents is not None:
+            new_tokens = 1 if input_ids.shape[1] == 1 else input_ids.shape[1] - mel_len
+            self.recorded_latents.append(self.lm_head[0](hidden_states[:, -new_tokens:]))
+
         lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
@@ -457,8 +492,41 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
+    def get_speech_prefix_embedding(self, speech_conditioning_latent, text_inputs):
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+
+        conds = speech_conditioning_latent.unsqueeze(1)
+        if conds.shape[0] != text_emb.shape[0]:
+            # A single conditioning latent can be shared by a batch of texts.
+            conds = conds.expand(text_emb.shape[0], -1, -1)
+        return torch.cat([conds, text_emb], dim=1)
+
+    def get_speech_prefix(self, speech_conditioning_latent, text_inputs):
+        """
+        Runs the conditioning+text prefix used by inference_speech() through the transformer once. The result can be
+        passed to inference_speech() as `speech_prefix` for every batch of samples generated from the same conditioning
+        latent and text, so that the prefix forward pass is not repeated for each batch.
+
+        :return: A tuple of (prefix_embedding, prefix_key_values).
+        """
+        emb = self.get_speech_prefix_embedding(speech_conditioning_latent, text_inputs)
+        gpt_out = self.gpt(inputs_embeds=emb, use_cache=True, return_dict=True)
+        return emb, gpt_out.past_key_values
+
     def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, speech_prefix=None,
+                         return_latent=False, **hf_generate_kwargs):
+        """
+        Samples MEL codes for the given conditioning latent and text.
+
+        If speech_prefix is specified (see get_speech_prefix()), the conditioning+text prefix is not recomputed.
+        If return_latent is specified, the final hidden states produced while sampling are returned alongside the codes,
+        as a (b,s,d) tensor aligned with the codes in the same way as forward() with return_latent=True. These are
+        computed from the sampled tokens, so positions after the stop token see stop tokens rather than the padding
+        applied by fix_autoregressive_output().
+        """
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         if not hasattr(self, 'inference_model'):
             # TODO: Decouple gpt_config from this inference model.
@@ -473,15 +541,15 @@ class UnifiedVoice(nn.Module):
             self.inference_model = GPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
             self.gpt.wte = self.mel_embedding
 
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
-        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-
-        conds = speech_conditioning_latent.unsqueeze(1)
-        emb = torch.cat([conds, text_emb], dim=1)
+        if speech_prefix is None:
+            emb = self.get_speech_prefix_embedding(speech_conditioning_latent, text_inputs)
+            prefix_past = None
+        else:
+            emb, prefix_past = speech_prefix
         self.inference_model.store_mel_emb(emb)
+        self.inference_model.store_prefix_past(prefix_past)
 
-        fake_inputs = torch.full((emb.shape[0], conds.shape[1] + emb.shape[1],), fill_value=1, dtype=torch.long,
+        fake_inputs = torch.full((emb.shape[0], emb.shape[1] + 1,), fill_value=1, dtype=torch.long,
                                  device=text_inputs.device)
         fake_inputs[:, -1] = self.start_mel_token
         trunc_index = fake_inputs.shape[1]
@@ -495,9 +563,14 @@ class UnifiedVoice(nn.Module):
 
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
+        if return_latent:
+            self.inference_model.start_recording_latents()
         gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
                                             max_length=max_length, logits_processor=logits_processor,
                                             num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        if return_latent:
+            latents = self.inference_model.stop_recording_latents()
+            return gen[:, trunc_index:], latents[:, :gen.shape[1] - trunc_index]
         return gen[:, trunc_index:]
 
 
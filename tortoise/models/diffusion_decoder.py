@@ -259,7 +259,16 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
-    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
+    def precompute_timestep_embeddings(self, timesteps):
+        """
+        Runs the given 1-D tensor of timesteps through the timestep embedding network once, so that sampling does not
+        need to repeat it at every step. The result can be passed to forward() as `timestep_embeddings`.
+        """
+        timesteps = timesteps.long().sort().values
+        return timesteps, self.time_embed(timestep_embedding(timesteps, self.model_channels))
+
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False,
+                timestep_embeddings=None, fused_conditioning_free=False):
         """
         Apply the model to an input batch.
 
@@ -269,10 +278,15 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+        :param timestep_embeddings: Embeddings returned from self.precompute_timestep_embeddings(), which must include every timestep in `timesteps`.
+        :param fused_conditioning_free: When set, x holds a batch of 2N: the first N elements are conditioned on the N aligned
+                                        inputs and the last N are conditioning-free. This is equivalent to calling this twice,
+                                        with conditioning_free unset and set, but only needs one forward pass.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
+        assert not (fused_conditioning_free and (conditioning_free or return_code_pred))
 
         unused_params = []
         if conditioning_free:
@@ -289,9 +303,16 @@ class DiffusionTts(nn.Module):
                 else:
                     unused_params.extend(list(self.latent_conditioner.parameters()))
 
-            unused_params.append(self.unconditioned_embedding)
+            if fused_conditioning_free:
+                code_emb = torch.cat([code_emb, self.unconditioned_embedding.repeat(code_emb.shape[0], 1, x.shape[-1])], dim=0)
+            else:
+                unused_params.append(self.unconditioned_embedding)
 
-        time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+        if timestep_embeddings is not None:
+            known_timesteps, known_embeddings = timestep_embeddings
+            time_emb = known_embeddings[torch.searchsorted(known_timesteps, timesteps.long())]
+        else:
+            time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
         code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
         x = self.inp_block(x)
         x = torch.cat([x, code_emb], dim=1)
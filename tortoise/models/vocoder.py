@@ -3,6 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 MAX_WAV_VALUE = 32768.0
+# Implementations of the location-variable convolution; see LVCBlock.
+LVC_IMPLEMENTATIONS = ('einsum', 'matmul', 'grouped_conv')
 
 class KernelPredictor(torch.nn.Module):
     ''' Kernel predictor for the location-variable convolutions'''
@@ -92,6 +94,13 @@ class KernelPredictor(torch.nn.Module):
 
         return kernels, bias
 
+    def receptive_field(self):
+        '''Number of conditioning frames on either side of a frame that its kernel depends on.'''
+        field = self.input_conv[0].padding[0] + self.kernel_conv.padding[0]
+        for block in self.residual_convs:
+            field += block[1].padding[0] + block[3].padding[0]
+        return field
+
     def remove_weight_norm(self):
         nn.utils.remove_weight_norm(self.input_conv[0])
         nn.utils.remove_weight_norm(self.kernel_conv)
@@ -116,9 +125,12 @@ class LVCBlock(torch.nn.Module):
             kpnet_hidden_channels=64,
             kpnet_conv_size=3,
             kpnet_dropout=0.0,
+            lvc_implementation='matmul',
     ):
         super().__init__()
 
+        assert lvc_implementation in LVC_IMPLEMENTATIONS
+        self.lvc_implementation = lvc_implementation
         self.cond_hop_length = cond_hop_length
         self.conv_layers = len(dilations)
         self.conv_kernel_size = conv_kernel_size
@@ -172,13 +184,24 @@ class LVCBlock(torch.nn.Module):
             k = kernels[:, i, :, :, :, :]  # (B, 2 * c_g, c_g, kernel_size, cond_length)
             b = bias[:, i, :, :]  # (B, 2 * c_g, cond_length)
 
-            output = self.location_variable_convolution(output, k, b,
-                                                        hop_size=self.cond_hop_length)  # (B, 2 * c_g, stride * L'): LVC
+            output = self.lvc(output, k, b, hop_size=self.cond_hop_length)  # (B, 2 * c_g, stride * L'): LVC
             x = x + torch.sigmoid(output[:, :in_channels, :]) * torch.tanh(
                 output[:, in_channels:, :])  # (B, c_g, stride * L'): GAU
 
         return x
 
+    def lvc(self, x, kernel, bias, dilation=1, hop_size=256):
+        ''' perform location-variable convolution with the implementation selected by self.lvc_implementation.
+        'matmul' gives exactly the same result as the original 'einsum' implementation, and is faster. 'grouped_conv' is
+        usually the fastest on CPU, but differs from the others by float rounding.
+        Time them with scripts/benchmark_vocoder.py.
+        '''
+        if self.lvc_implementation == 'matmul':
+            return self.location_variable_convolution_matmul(x, kernel, bias, dilation, hop_size)
+        if self.lvc_implementation == 'grouped_conv':
+            return self.location_variable_convolution_grouped_conv(x, kernel, bias, dilation, hop_size)
+        return self.location_variable_convolution(x, kernel, bias, dilation, hop_size)
+
     def location_variable_convolution(self, x, kernel, bias, dilation=1, hop_size=256):
         ''' perform location-variable convolution operation on the input sequence (x) using the local convolution kernl.
         Time: 414 μs ± 309 ns per loop (mean ± std. dev. of 7 runs, 1000 loops each), test on NVIDIA V100.
@@ -215,6 +238,42 @@ class LVCBlock(torch.nn.Module):
 
         return o
 
+    def location_variable_convolution_matmul(self, x, kernel, bias, dilation=1, hop_size=256):
+        ''' location_variable_convolution() as a single batched matmul: the kernel taps of every input sample are
+        gathered once (im2col) and multiplied with the kernel of the frame the sample falls in.
+        '''
+        batch, in_channels, in_length = x.shape
+        batch, _, out_channels, kernel_size, kernel_length = kernel.shape
+        assert in_length == (kernel_length * hop_size), "length of (x, kernel) is not matched"
+
+        padding = dilation * int((kernel_size - 1) / 2)
+        x = F.pad(x, (padding, padding), 'constant', 0)  # (batch, in_channels, in_length + 2*padding)
+        x = x.unfold(2, dilation * (kernel_size - 1) + 1, 1)[..., ::dilation]  # (batch, in_channels, in_length, kernel_size)
+        x = x.reshape(batch, in_channels, kernel_length, hop_size, kernel_size).permute(0, 2, 3, 1, 4)
+        x = x.reshape(batch, kernel_length, hop_size, in_channels * kernel_size)
+        kernel = kernel.permute(0, 4, 1, 3, 2).reshape(batch, kernel_length, in_channels * kernel_size, out_channels)
+
+        o = torch.matmul(x, kernel)  # (batch, kernel_length, hop_size, out_channels)
+        o = o + bias.transpose(1, 2).unsqueeze(2)
+        return o.permute(0, 3, 1, 2).reshape(batch, out_channels, in_length)
+
+    def location_variable_convolution_grouped_conv(self, x, kernel, bias, dilation=1, hop_size=256):
+        ''' location_variable_convolution() as one grouped conv1d, with a group per (batch, frame) pair.
+        '''
+        batch, in_channels, in_length = x.shape
+        batch, _, out_channels, kernel_size, kernel_length = kernel.shape
+        assert in_length == (kernel_length * hop_size), "length of (x, kernel) is not matched"
+
+        padding = dilation * int((kernel_size - 1) / 2)
+        x = F.pad(x, (padding, padding), 'constant', 0)
+        x = x.unfold(2, hop_size + 2 * padding, hop_size)  # (batch, in_channels, kernel_length, hop_size + 2*padding)
+        x = x.transpose(1, 2).reshape(1, batch * kernel_length * in_channels, hop_size + 2 * padding)
+        weight = kernel.permute(0, 4, 2, 1, 3).reshape(batch * kernel_length * out_channels, in_channels, kernel_size)
+
+        o = F.conv1d(x, weight, bias.transpose(1, 2).reshape(-1), dilation=dilation, groups=batch * kernel_length)
+        o = o.view(batch, kernel_length, out_channels, hop_size)
+        return o.permute(0, 2, 1, 3).reshape(batch, out_channels, in_length)
+
     def remove_weight_norm(self):
         self.kernel_predictor.remove_weight_norm()
         nn.utils.remove_weight_norm(self.convt_pre[1])
@@ -231,7 +290,7 @@ class UnivNetGenerator(nn.Module):
 
     def __init__(self, noise_dim=64, channel_size=32, dilations=[1,3,9,27], strides=[8,8,4], lReLU_slope=.2, kpnet_conv_size=3,
                  # Below are MEL configurations options that this generator requires.
-                 hop_length=256, n_mel_channels=100):
+                 hop_length=256, n_mel_channels=100, lvc_implementation='matmul'):
         super(UnivNetGenerator, self).__init__()
         self.mel_channel = n_mel_channels
         self.noise_dim = noise_dim
@@ -251,7 +310,8 @@ class UnivNetGenerator(nn.Module):
                     dilations=dilations,
                     lReLU_slope=lReLU_slope,
                     cond_hop_length=hop_length,
-                    kpnet_conv_size=kpnet_conv_size
+                    kpnet_conv_size=kpnet_conv_size,
+                    lvc_implementation=lvc_implementation,
                 )
             )
 
@@ -281,6 +341,12 @@ class UnivNetGenerator(nn.Module):
 
         return z
 
+    def set_lvc_implementation(self, lvc_implementation):
+        '''Selects the location-variable convolution implementation used by every LVC block. See LVC_IMPLEMENTATIONS.'''
+        assert lvc_implementation in LVC_IMPLEMENTATIONS
+        for res_block in self.res_stack:
+            res_block.lvc_implementation = lvc_implementation
+
     def eval(self, inference=False):
         super(UnivNetGenerator, self).eval()
         # don't remove weight norm while validation in training loop
@@ -311,6 +377,111 @@ class UnivNetGenerator(nn.Module):
         audio = audio.clamp(min=-1, max=1)
         return audio
 
+    def inference_windows(self, c, window=100, context=None, z=None):
+        '''
+        Like inference(), but vocodes the MEL in windows of `window` frames and yields the audio of each window as soon
+        as it is ready. See StreamingVocoder.
+        '''
+        stream = StreamingVocoder(self, window=window, context=context, z=z)
+        for start in range(0, c.shape[2], window):
+            yield from stream.push(c[:, :, start:start + window])
+        yield from stream.flush()
+
+    def receptive_field(self):
+        '''
+        Returns the number of MEL frames on either side of a frame that the audio of that frame depends on, through
+        both the kernel predictors and the LVC stacks.
+        '''
+        samples = self.conv_post[1].padding[0]  # Context at the rate of the current block's output.
+        frames = 0
+        for block in reversed(self.res_stack):
+            samples += sum(conv[1].padding[0] for conv in block.conv_blocks)
+            samples += block.conv_layers * (block.conv_kernel_size - 1) // 2  # The LVCs themselves.
+            kernel_frames = -(-samples // block.cond_hop_length)
+            frames = max(frames, kernel_frames + block.kernel_predictor.receptive_field())
+            samples = -(-samples // block.convt_pre[1].stride[0]) + 1
+        return max(frames, samples + self.conv_pre.padding[0])
+
+
+class StreamingVocoder:
+    '''
+    Vocodes a MEL spectrogram which arrives a few frames at a time. Audio is produced in windows of `window` frames as
+    soon as `context` frames past the end of a window have arrived, and every window is vocoded with `context` frames on
+    either side of it, which are then discarded. With the default context (the receptive field of the vocoder), the
+    output matches UnivNetGenerator.inference() on the whole spectrogram, while latency and memory use are bounded by
+    the window and context sizes.
+    '''
+
+    def __init__(self, vocoder, window=100, context=None, z=None):
+        '''
+        :param vocoder: The UnivNetGenerator to vocode with.
+        :param window: Number of MEL frames vocoded at a time.
+        :param context: Number of frames of context on either side of each window. Defaults to the receptive field of
+                        the vocoder.
+        :param z: Optional (b,noise_dim,s) noise for the whole spectrogram, including the 10 frames of padding added by
+                  flush(). If omitted, noise is drawn as frames arrive.
+        '''
+        self.vocoder = vocoder
+        self.window = window
+        self.context = vocoder.receptive_field() if context is None else context
+        self.z = z
+        self.mel = None
+        self.noise = None
+        self.buffer_start = 0  # Index of the first buffered frame.
+        self.emitted = 0  # Index of the first frame whose audio has not been produced yet.
+        self.received = 0
+
+    def push(self, c):
+        '''
+        Adds the (b,mel_channels,s) frames <c> to the end of the spectrogram.
+        :return: A list of the (b,1,samples) audio chunks which became ready, possibly empty.
+        '''
+        self._append(c)
+        chunks = []
+        while self.received - self.emitted >= self.window + self.context:
+            chunks.append(self._vocode(self.emitted + self.window))
+        return chunks
+
+    def flush(self):
+        '''
+        Ends the spectrogram and returns the audio of all remaining frames. Like inference(), the spectrogram is padded
+        with silence first, to avoid artifacts at its end.
+        '''
+        if self.mel is None:
+            return []
+        end = self.received
+        self._append(torch.full((self.mel.shape[0], self.vocoder.mel_channel, 10), -11.5129, device=self.mel.device))
+        chunks = []
+        while self.emitted < end:
+            chunks.append(self._vocode(min(self.emitted + self.window, end)))
+        return chunks
+
+    def _append(self, c):
+        if self.z is not None:
+            noise = self.z[:, :, self.received:self.received + c.shape[2]].to(c.device)
+        else:
+            noise = torch.randn(c.shape[0], self.vocoder.noise_dim, c.shape[2], device=c.device)
+        self.mel = c if self.mel is None else torch.cat([self.mel, c], dim=2)
+        self.noise = noise if self.noise is None else torch.cat([self.noise, noise], dim=2)
+        self.received += c.shape[2]
+
+    def _vocode(self, end):
+        start = self.emitted
+        ctx_start = max(self.buffer_start, start - self.context)
+        ctx_end = min(self.received, end + self.context)
+        audio = self.vocoder(self.mel[:, :, ctx_start - self.buffer_start:ctx_end - self.buffer_start],
+                             self.noise[:, :, ctx_start - self.buffer_start:ctx_end - self.buffer_start])
+        hop_length = self.vocoder.hop_length
+        audio = audio[:, :, (start - ctx_start) * hop_length:(end - ctx_start) * hop_length]
+        self.emitted = end
+
+        # Frames before the left context of the next window are no longer needed.
+        drop = max(0, self.emitted - self.context - self.buffer_start)
+        self.mel = self.mel[:, :, drop:]
+        self.noise = self.noise[:, :, drop:]
+        self.buffer_start += drop
+        return audio.clamp(min=-1, max=1)
+
 
 if __name__ == '__main__':
     model = UnivNetGenerator()
@@ -325,3 +496,83 @@ if __name__ == '__main__':
 
     pytorch_total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(pytorch_total_params)
+
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_receptive_field(self):
+            torch.manual_seed(0)
+            model = UnivNetGenerator()
+            model.eval()
+            c = torch.randn(1, 100, 60)
+            z = torch.randn(1, 64, 60)
+            with torch.no_grad():
+                y = model(c, z)
+                c[:, :, 30] += 1
+                changed = (model(c, z) - y).abs().view(60, -1).amax(dim=1).nonzero().flatten()
+            field = model.receptive_field()
+            self.assertGreaterEqual(field, 30 - changed.min().item())
+            self.assertGreaterEqual(field, changed.max().item() - 30)
+
+        def test_streaming_matches_whole_clip(self):
+            torch.manual_seed(0)
+            model = UnivNetGenerator()
+            model.eval(inference=True)
+            c = torch.randn(2, 100, 137)
+            z = torch.randn(2, 64, 147)
+            with torch.no_grad():
+                expected = model.inference(c, z)
+                stream = StreamingVocoder(model, window=20, z=z)
+                chunks = []
+                for start, end in [(0, 7), (7, 50), (50, 51), (51, 137)]:
+                    chunks.extend(stream.push(c[:, :, start:end]))
+                chunks.extend(stream.flush())
+            self.assertTrue(all(chunk.shape[-1] <= 20 * model.hop_length for chunk in chunks))
+            self.assertEqual(stream.mel.shape[-1], stream.received - stream.buffer_start)
+            self.assertLessEqual(stream.mel.shape[-1], 20 + 2 * stream.context + 10)
+            self.assertTrue(torch.allclose(torch.cat(chunks, dim=-1), expected, atol=1e-4))
+
+        def test_lvc_implementations_match(self):
+            def reference_lvc(x, kernel, bias, dilation, hop_size):
+                # Convolves each conditioning frame's slice of x with that frame's kernel, one at a time.
+                kernel_size = kernel.shape[3]
+                padding = dilation * (kernel_size - 1) // 2
+                x = F.pad(x, (padding, padding))
+                frames = []
+                for t in range(kernel.shape[-1]):
+                    segment = x[:, :, t * hop_size:(t + 1) * hop_size + 2 * padding]
+                    frames.append(torch.cat([F.conv1d(segment[b:b + 1], kernel[b, :, :, :, t].transpose(0, 1), bias[b, :, t],
+                                                      dilation=dilation) for b in range(x.shape[0])], dim=0))
+                return torch.cat(frames, dim=-1)
+
+            torch.manual_seed(0)
+            block = LVCBlock(8, 100, stride=8, cond_hop_length=16)
+            # The dilations and conditioning hop sizes of the shipped UnivNet config.
+            for hop_size in (8, 64, 256):
+                for dilation in (1, 3, 9, 27):
+                    x = torch.randn(2, 8, 5 * hop_size)
+                    kernel = torch.randn(2, 8, 16, 3, 5)
+                    bias = torch.randn(2, 16, 5)
+                    expected = reference_lvc(x, kernel, bias, dilation, hop_size)
+                    matmul = block.location_variable_convolution_matmul(x, kernel, bias, dilation, hop_size)
+                    self.assertTrue(torch.allclose(matmul, expected, atol=1e-6))
+                    grouped_conv = block.location_variable_convolution_grouped_conv(x, kernel, bias, dilation, hop_size)
+                    self.assertTrue(torch.allclose(grouped_conv, expected, atol=1e-4))
+                    if hop_size % dilation == 0 or dilation % hop_size == 0:
+                        # The original implementation only handles dilations which divide the hop size or vice versa.
+                        einsum = block.location_variable_convolution(x, kernel, bias, dilation, hop_size)
+                        self.assertTrue(torch.allclose(einsum, expected, atol=1e-6))
+
+            model = UnivNetGenerator()
+            model.eval(inference=True)
+            c = torch.randn(2, 100, 20)
+            z = torch.randn(2, 64, 30)  # inference() pads the MEL with 10 frames of silence.
+            outputs = {}
+            with torch.no_grad():
+                for implementation in LVC_IMPLEMENTATIONS:
+                    model.set_lvc_implementation(implementation)
+                    outputs[implementation] = model.inference(c, z)
+            self.assertTrue(torch.allclose(outputs['matmul'], outputs['einsum'], atol=1e-6))
+            self.assertTrue(torch.allclose(outputs['grouped_conv'], outputs['einsum'], atol=1e-5))
+
+    unittest.main()
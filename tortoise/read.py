@@ -8,8 +8,10 @@ import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
 from utils.audio import load_audio, load_voices
+from utils.qa import add_qa_arguments, qa_policy_from_args
 from utils.text import split_and_recombine_text
 from scripts.file_utils import get_leaf_files
+from scripts.process_text import normalize_text
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--textdir', type=str, help='A dir containing the texts to read.', default=None)
@@ -18,6 +20,9 @@ parser.add_argument('--voice', type=str, help='Selects the voice to use for gene
 parser.add_argument('--outdir', type=str, help='Where to store outputs.', default='results/')
 parser.add_argument('--fix', help='Enable failure fixing mode.', default=False, action='store_true')
 parser.add_argument('--qa', help='Enable QA with stt.', default=False, action='store_true')
+add_qa_arguments(parser)
+parser.add_argument('--normalize', help='Expand abbreviations and symbols in the text (as scripts/process_text.py does) before reading it.',
+                    default=False, action='store_true')
 
 parser.add_argument('--textfile', type=str, help='A file containing the text to read.', default="tortoise/data/riding_hood.txt")
 parser.add_argument('--batch_size', type=int, help='Batch size to use.', default=16)
@@ -37,6 +42,7 @@ if __name__ == '__main__':
     selected_voices = args.voice.split(',')
 
     use_stt = args.qa or args.fix
+    qa_policy = qa_policy_from_args(args)
 
     if args.textdir is not None:
         text_paths = [p for p in get_leaf_files(args.textdir) if p.endswith('.txt')]
@@ -71,6 +77,8 @@ if __name__ == '__main__':
             # Process text
             with open(textfile, 'r', encoding='utf-8') as f:
                 text = ' '.join([l for l in f.readlines()])
+            if args.normalize:
+                text = normalize_text(text)
             if '|' in text:
                 print("Found the '|' character in your text, which I will use as a cue for where to split it up. If this was not"
                     "your intent, please remove all '|' characters from the input.")
@@ -114,34 +122,42 @@ if __name__ == '__main__':
                 voice_samples, conditioning_latents = load_voices(voice_sel)
 
                 failed = {}
-                all_parts = []
+                parts = {}
+                pending = []
                 for segment_index, text in enumerate(texts):
-                    print(f'\n{textfiles_count}/{total_num_files}: {filename}\n{segment_index + 1}/{len(texts)}: {text}\n{selected_voice}')
-
                     wav_path = os.path.join(audio_dir, f'{segment_index}.wav')
                     # Skip if we are not regenerating this clip and audio exists
                     if (not regenerate or segment_index not in regenerate) and os.path.exists(wav_path):
-                        all_parts.append(load_audio(wav_path, 24000))
+                        parts[segment_index] = load_audio(wav_path, 24000)
                         continue
 
+                    print(f'\n{textfiles_count}/{total_num_files}: {filename}\n{segment_index + 1}/{len(texts)}: {text}\n{selected_voice}')
                     # Write text clip to file to match audio clips
                     with open(os.path.join(audio_dir, f'{segment_index}.txt'), 'w') as f:
                         f.write(text)
+                    pending.append(segment_index)
 
+                if pending:
+                    # Pending segments are generated in groups of --batch_size, so short segments share the device. Each
+                    # clip is saved as soon as its group is done, so an interrupted run resumes where it left off.
                     candidates = 10 if args.fix else 1
-                    generated, stt_result = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                                    preset=args.preset, k=candidates, use_deterministic_seed=seed, use_stt_check=use_stt)
-                    generated = generated.squeeze(0).cpu()
-                    torchaudio.save(wav_path, generated, 24000)
-                    if use_stt:
-                        # Save the sentence timestamps
-                        with open(os.path.join(audio_dir, f'{segment_index}.timestamps'), "w") as f:
-                            for segment in stt_result['segments']:
-                                f.write(f"{segment['start']}-{segment['end']}: {segment['text']}\n")
-
-                    all_parts.append(generated)
-                    if use_stt and 'passed' not in stt_result:
-                        failed[str(segment_index)] = (text, stt_result['text'].strip())
+                    generated = tts.iter_tts_batch_with_preset([texts[i] for i in pending], voice_samples=voice_samples,
+                                                               conditioning_latents=conditioning_latents, preset=args.preset,
+                                                               k=candidates, use_deterministic_seed=seed, use_stt_check=use_stt,
+                                                               qa_policy=qa_policy)
+                    for segment_index, (clip, stt_result) in zip(pending, generated):
+                        clip = clip.squeeze(0).cpu()
+                        torchaudio.save(os.path.join(audio_dir, f'{segment_index}.wav'), clip, 24000)
+                        if use_stt:
+                            # Save the sentence timestamps
+                            with open(os.path.join(audio_dir, f'{segment_index}.timestamps'), "w") as f:
+                                for segment in stt_result['segments']:
+                                    f.write(f"{segment['start']}-{segment['end']}: {segment['text']}\n")
+
+                        parts[segment_index] = clip
+                        if use_stt and 'passed' not in stt_result:
+                            failed[str(segment_index)] = (texts[segment_index], stt_result['text'].strip())
+                all_parts = [parts[i] for i in sorted(parts.keys())]
 
                 # Save the clip ids that failed speech-to-text test
                 if use_stt:
@@ -0,0 +1,48 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from tortoise.utils.stft import STFT, STFT_BACKENDS
+
+parser = argparse.ArgumentParser(description='Times each STFT backend with the settings used for the diffusion '
+                                             'conditioning MELs (1024 point FFT, hop of 256).')
+parser.add_argument('--lengths', type=str, default='1,4.27,10',
+                    help='Comma separated clip lengths to time, in seconds of 24kHz audio. 4.27s (102400 samples) is '
+                         'the length of every diffusion conditioning clip.')
+parser.add_argument('--batch-size', type=int, default=1, help='Number of clips transformed at once.')
+parser.add_argument('--repeats', type=int, default=20, help='Number of timed runs per setting.')
+parser.add_argument('--device', type=str, default='cpu', help='Device to run on.')
+
+
+def time_call(fn, repeats, device):
+    fn()  # Warm up.
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    stfts = {backend: STFT(1024, 256, 1024, backend=backend).to(device) for backend in STFT_BACKENDS}
+
+    print(f'{"seconds":>8} {"backend":>8} {"transform ms":>13} {"inverse ms":>11} {"max diff":>10}')
+    for seconds in [float(l) for l in args.lengths.split(',')]:
+        audio = torch.rand(args.batch_size, int(seconds * 24000), device=device) * 2 - 1
+        reference = None
+        with torch.no_grad():
+            for backend, stft in stfts.items():
+                magnitude, phase = stft.transform(audio)
+                if reference is None:
+                    reference = magnitude
+                transform_time = time_call(lambda: stft.transform(audio), args.repeats, device)
+                inverse_time = time_call(lambda: stft.inverse(magnitude, phase), args.repeats, device)
+                diff = (magnitude - reference).abs().max().item()
+                print(f'{seconds:>8} {backend:>8} {transform_time * 1000:>13.2f} {inverse_time * 1000:>11.2f} '
+                      f'{diff:>10.2e}')
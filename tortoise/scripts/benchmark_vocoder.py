@@ -0,0 +1,58 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from tortoise.models.vocoder import LVC_IMPLEMENTATIONS, UnivNetGenerator
+
+parser = argparse.ArgumentParser(description='Times each location-variable convolution implementation on the input '
+                                             'shapes every LVC block of the UnivNet vocoder sees. Inputs are random, '
+                                             'so no checkpoint is needed.')
+parser.add_argument('--mel-lengths', type=str, default='94,375,940',
+                    help='Comma separated MEL lengths to time, in frames (~94 per second of audio).')
+parser.add_argument('--batch-size', type=int, default=1, help='Number of clips vocoded at once.')
+parser.add_argument('--repeats', type=int, default=10, help='Number of timed runs per setting.')
+parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads torch may use.')
+parser.add_argument('--device', type=str, default='cpu', help='Device to run on.')
+
+
+def time_call(fn, repeats, device):
+    with torch.no_grad():
+        output = fn()  # Warm up.
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = perf_counter()
+        for _ in range(repeats):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (perf_counter() - start) / repeats, output
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = UnivNetGenerator()
+    channels = model.res_stack[0].kernel_predictor.conv_in_channels
+    kernel_size = model.res_stack[0].conv_kernel_size
+
+    print(f'{"frames":>8} {"hop":>5} {"implementation":>15} {"ms":>10} {"speedup":>8} {"max diff":>10}')
+    for length in [int(l) for l in args.mel_lengths.split(',')]:
+        for block in model.res_stack:
+            hop_size = block.cond_hop_length
+            # The shapes LVCBlock.forward() passes to the convolution: the upsampled signal and one kernel per frame.
+            x = torch.randn(args.batch_size, channels, length * hop_size, device=device)
+            kernel = torch.randn(args.batch_size, channels, 2 * channels, kernel_size, length, device=device)
+            bias = torch.randn(args.batch_size, 2 * channels, length, device=device)
+            baseline = None
+            for implementation in LVC_IMPLEMENTATIONS:
+                block.lvc_implementation = implementation
+                elapsed, output = time_call(lambda: block.lvc(x, kernel, bias, hop_size=hop_size), args.repeats, device)
+                if baseline is None:
+                    baseline = (elapsed, output)
+                diff = (output - baseline[1]).abs().max().item()
+                print(f'{length:>8} {hop_size:>5} {implementation:>15} {elapsed * 1000:>10.2f} '
+                      f'{baseline[0] / elapsed:>7.2f}x {diff:>10.2e}')
@@ -1,7 +1,6 @@
-import re
 import argparse
 
-from file_utils import get_leaf_files
+from tortoise.utils.text import TextNormalizer
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dir', type=str, help='Directory to trace for text files.', default=None)
@@ -118,8 +117,13 @@ ABBREVS = {
     'YG': ' Young Gangsta ',
 }
 
+# Applies REPLACE, then ABBREVS to whole words.
+normalize_text = TextNormalizer(REPLACE, ABBREVS)
+
 
 if __name__ == '__main__':
+    from file_utils import get_leaf_files
+
     args = parser.parse_args()
     textfiles = [p for p in get_leaf_files(args.dir) if p.endswith('.txt')]
     for path in textfiles:
@@ -127,10 +131,7 @@ if __name__ == '__main__':
             text = f.read()
         old_text = text
 
-        for k, v in REPLACE.items():
-            text = re.sub(k, v, text)
-        for k, v in ABBREVS.items():
-            text = re.sub(r'\b' + k + r'\b', v, text)
+        text = normalize_text(text)
 
         if text != old_text:
             print(path)
@@ -1,58 +1,217 @@
 import argparse
+import dataclasses
 import glob
 import os
-import re
 
+import torch
 import whisper
+from whisper.decoding import DecodingOptions, DecodingTask
 
 from scripts.file_utils import has_subdirectories
+from utils.qa import add_qa_arguments, qa_policy_from_args
+from utils.voice_cache import VoiceCache, hash_file
+
+TRANSCRIPT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tortoise', 'transcripts')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--audio', type=str, help='A dir containing the result audio to qa test.', default=None)
+parser.add_argument('--model', type=str, help='Which whisper model to transcribe with.', default='large-v2')
+parser.add_argument('--batch_size', type=int, help='Number of clips transcribed by whisper at once.', default=16)
+parser.add_argument('--cache_dir', type=str, help='Where transcripts are cached, keyed by the contents of each wav file, so '
+                                                  'that only new or changed clips are transcribed again.',
+                    default=TRANSCRIPT_CACHE_DIR)
+parser.add_argument('--cache_size_gb', type=float, help='Maximum size of the transcript cache, in GB. The least recently '
+                                                       'used transcripts are deleted when it grows larger.', default=0.25)
+parser.add_argument('--no_cache', help='Transcribe every clip, even if its transcript is cached.', default=False,
+                    action='store_true')
+add_qa_arguments(parser)
+
+
+class BatchTranscriber:
+    """
+    Transcribes wav files with whisper in batches. Clips which fit in whisper's 30 second window are padded to it and
+    decoded together; longer clips fall back to whisper's own transcribe(). Like transcribe(), clips whose greedy decode
+    looks repetitive or unlikely are decoded again at increasing temperatures, so the transcripts match the ones
+    transcribe() produces. Transcripts are cached by the contents of each wav file, so a clip is only transcribed again
+    when its audio changes.
+    """
+
+    def __init__(self, model, model_name, batch_size=16, language='en', cache=None,
+                 temperatures=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0), compression_ratio_threshold=2.4, logprob_threshold=-1.0,
+                 no_speech_threshold=0.6):
+        """
+        :param model: The whisper model.
+        :param model_name: Name of the model, which is part of the cache key.
+        :param batch_size: Number of clips decoded at once.
+        :param language: Language of the clips. Fixing it skips whisper's language detection.
+        :param cache: VoiceCache that transcripts are stored in. None disables caching.
+        :param temperatures: Temperatures tried in turn for clips whose decode fails the checks below. These and the
+                             thresholds default to the values whisper's transcribe() uses.
+        :param compression_ratio_threshold: Decodes whose text gzip-compresses better than this are treated as failed.
+        :param logprob_threshold: Decodes whose average log probability is below this are treated as failed.
+        :param no_speech_threshold: Clips whose no-speech probability is above this and whose decode fails the log
+                                    probability check are treated as silent, and transcribed as empty text.
+        """
+        self.model = model
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.language = language
+        self.cache = cache
+        self.options = DecodingOptions(language=language, fp16=model.device.type == 'cuda')
+        self.temperatures = temperatures
+        self.compression_ratio_threshold = compression_ratio_threshold
+        self.logprob_threshold = logprob_threshold
+        self.no_speech_threshold = no_speech_threshold
+        # Each timestamp token is worth this many seconds; see whisper.transcribe().
+        self.time_precision = whisper.audio.N_FRAMES // model.dims.n_audio_ctx * whisper.audio.HOP_LENGTH / whisper.audio.SAMPLE_RATE
+
+    def transcribe(self, wav_paths):
+        """
+        :return: A list with a dict for each wav file, holding its 'text' and a list of 'segments', each with a 'start',
+                 'end' and 'text', as returned by whisper's transcribe().
+        """
+        results = [None] * len(wav_paths)
+        keys = [VoiceCache.make_key(hash_file(path), self.model_name, self.language) for path in wav_paths]
+        short_clips = []
+        for i, (path, key) in enumerate(zip(wav_paths, keys)):
+            results[i] = self.cache.get(key) if self.cache is not None else None
+            if results[i] is not None:
+                continue
+            audio = whisper.load_audio(path)
+            if audio.shape[-1] > whisper.audio.N_SAMPLES:
+                results[i] = self.model.transcribe(audio, language=self.language, fp16=self.options.fp16)
+                self._store(key, results[i])
+            else:
+                short_clips.append((i, audio))
+            if len(short_clips) == self.batch_size:
+                self._transcribe_batch(short_clips, keys, results)
+                short_clips = []
+        if short_clips:
+            self._transcribe_batch(short_clips, keys, results)
+        return results
+
+    def _transcribe_batch(self, clips, keys, results):
+        # Whisper releases from before the large-v3 model have no n_mels and always use 80 MEL bins.
+        n_mels = getattr(self.model.dims, 'n_mels', 80)
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels)
+                            for _, audio in clips]).to(self.model.device)
+        decoded = [None] * len(clips)
+        remaining = list(range(len(clips)))
+        for temperature in self.temperatures:
+            # Only the clips whose decode failed at the previous temperature are decoded again.
+            task = DecodingTask(self.model, dataclasses.replace(self.options, temperature=temperature))
+            with torch.no_grad():
+                attempts = task.run(mels[remaining])
+            failed = []
+            for j, result in zip(remaining, attempts):
+                decoded[j] = result
+                if self._needs_fallback(result):
+                    failed.append(j)
+            remaining = failed
+            if not remaining:
+                break
+        for (i, audio), result in zip(clips, decoded):
+            if self._is_silent(result):
+                # transcribe() drops segments it decides are silent.
+                results[i] = {'text': '', 'segments': []}
+            else:
+                duration = audio.shape[-1] / whisper.audio.SAMPLE_RATE
+                results[i] = {'text': result.text, 'segments': self._segments(task.tokenizer, result.tokens, duration)}
+            self._store(keys[i], results[i])
+
+    def _is_silent(self, result):
+        """
+        Whether whisper's transcribe() would skip the clip as having no speech.
+        """
+        return (self.no_speech_threshold is not None and result.no_speech_prob > self.no_speech_threshold and
+                self.logprob_threshold is not None and result.avg_logprob < self.logprob_threshold)
 
-def check_texts_approx_match(gt_text, stt_text):
-    gt_tokens = [t for t in gt_text.split() if bool(re.search(r'[a-zA-Z0-9]', t))]
-    stt_tokens = [t for t in stt_text.split() if bool(re.search(r'[a-zA-Z0-9]', t))]
-    if len(stt_tokens) - len(gt_tokens) > 1 and sum([len(t) for t in stt_tokens]) - sum([len(t) for t in gt_tokens]) > 6:
-        return False
-    return True
+    def _needs_fallback(self, result):
+        """
+        Applies the checks whisper's transcribe() uses to decide whether a decode should be retried at a higher
+        temperature.
+        """
+        if self._is_silent(result):
+            return False  # There is nothing better to find.
+        if self.compression_ratio_threshold is not None and result.compression_ratio > self.compression_ratio_threshold:
+            return True
+        return self.logprob_threshold is not None and result.avg_logprob < self.logprob_threshold
+
+    def _segments(self, tokenizer, tokens, duration):
+        """
+        Splits decoded tokens into segments at the timestamp tokens which whisper emits around each one.
+        """
+        segments = []
+        start = 0.
+        text_tokens = []
+        for token in tokens:
+            if token >= tokenizer.timestamp_begin:
+                time = round((token - tokenizer.timestamp_begin) * self.time_precision, 2)
+                if text_tokens:
+                    segments.append({'start': start, 'end': time, 'text': tokenizer.decode(text_tokens)})
+                    text_tokens = []
+                start = time
+            else:
+                text_tokens.append(token)
+        if text_tokens:
+            segments.append({'start': start, 'end': max(start, round(duration, 2)), 'text': tokenizer.decode(text_tokens)})
+        return segments
+
+    def _store(self, key, result):
+        if self.cache is not None:
+            self.cache.put(key, {'text': result['text'],
+                                 'segments': [{k: s[k] for k in ('start', 'end', 'text')} for s in result['segments']]})
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     leaf_dirs = [d for d, _, _ in os.walk(args.audio) if os.path.isdir(d) and not has_subdirectories(d)]
 
-    if leaf_dirs:
-        model = whisper.load_model("large-v2")
+    clips = {}
+    for leaf_dir in leaf_dirs:
+        if os.path.exists(os.path.join(leaf_dir, 'fails')):
+            print(f"Skipping {leaf_dir}")
+            continue
+        clips[leaf_dir] = []
+        for wav_path in glob.glob(os.path.join(leaf_dir, "*.wav")):
+            section_num = wav_path.split('/')[-1].rstrip('.wav')
+            txt_path = os.path.join(leaf_dir, f"{section_num}.txt")
+            if os.path.exists(txt_path):
+                clips[leaf_dir].append((section_num, wav_path, txt_path))
 
-        for leaf_dir in leaf_dirs:
-            if os.path.exists(os.path.join(leaf_dir, 'fails')):
-                print(f"Skipping {leaf_dir}")
-                continue
+    wav_paths = [wav_path for dir_clips in clips.values() for _, wav_path, _ in dir_clips]
+    if wav_paths:
+        model = whisper.load_model(args.model)
+        qa_policy = qa_policy_from_args(args)
+        cache = None if args.no_cache else VoiceCache(args.cache_dir, max_size_bytes=int(args.cache_size_gb * (1024 ** 3)))
+        # Every clip is transcribed up front, so that batches are filled across directories.
+        transcriber = BatchTranscriber(model, args.model, batch_size=args.batch_size, cache=cache)
+        transcripts = iter(transcriber.transcribe(wav_paths))
+        if cache is not None:
+            print(f"Transcribed {cache.misses} clips; {cache.hits} were unchanged since the last run.")
 
+        for leaf_dir, dir_clips in clips.items():
             print(f"Testing {leaf_dir}")
             incorrect = {}
+            transcribed = {}
 
-            wav_paths = glob.glob(os.path.join(leaf_dir, "*.wav"))
-            for wav_path in wav_paths:
-                section_num = wav_path.split('/')[-1].rstrip('.wav')
-                txt_path = os.path.join(leaf_dir, f"{section_num}.txt")
-                if not os.path.exists(txt_path):
-                    continue
-                print(wav_path)
-
+            for section_num, wav_path, txt_path in dir_clips:
                 with open(txt_path, "r") as f:
                     gt_text = f.read().strip()
-                result = model.transcribe(wav_path)
-                stt_text = result['text'].strip()
-                if not check_texts_approx_match(gt_text, stt_text):
-                    print('Mismatch')
-                    incorrect[section_num] = (gt_text, stt_text)
+                result = next(transcripts)
+                transcribed[section_num] = (gt_text, result['text'].strip())
 
                 with open(os.path.join(leaf_dir, f'{section_num}.timestamps'), "w") as f:
                     for segment in result['segments']:
                         f.write(f"{segment['start']}-{segment['end']}: {segment['text']}\n")
 
+            # Every clip in the directory is scored in one batch once they have all been transcribed.
+            scores = qa_policy.check([gt for gt, _ in transcribed.values()], [stt for _, stt in transcribed.values()])
+            for (section_num, (gt_text, stt_text)), score in zip(transcribed.items(), scores):
+                if not score['passed']:
+                    print(f"Mismatch in {section_num} (WER {score['wer']:.2f}, CER {score['cer']:.2f})")
+                    incorrect[section_num] = (gt_text, stt_text)
+
             if incorrect:
                 with open(os.path.join(leaf_dir, "fails"), "w") as f:
                     f.write(','.join(incorrect.keys()) + '\n')
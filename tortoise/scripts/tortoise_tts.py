@@ -12,6 +12,7 @@ import torchaudio
 from tortoise.api import MODELS_DIR, TextToSpeech
 from tortoise.utils.audio import get_voices, load_voices, load_audio
 from tortoise.utils.text import split_and_recombine_text
+from tortoise.utils.voice_cache import VOICE_CACHE_DIR, configure_voice_cache
 
 parser = argparse.ArgumentParser(
     description='TorToiSe is a text-to-speech program that is capable of synthesizing speech '
@@ -29,7 +30,7 @@ parser.add_argument(
     '-V, --voices-dir', metavar='VOICES_DIR', type=str, dest='voices_dir',
     help='Path to directory containing extra voices to be loaded. Use a comma to specify multiple directories.')
 parser.add_argument(
-    '-p, --preset', type=str, default='fast', choices=['ultra_fast', 'fast', 'standard', 'high_quality'], dest='preset',
+    '-p, --preset', type=str, default='fast', choices=['ultra_fast', 'fast', 'standard', 'high_quality', 'fast_ddim', 'standard_ddim', 'fast_dpm', 'standard_dpm'], dest='preset',
     help='Which voice quality preset to use.')
 parser.add_argument(
     '-q, --quiet', default=False, action='store_true', dest='quiet',
@@ -79,6 +80,13 @@ advanced_group.add_argument(
     help='Normally text enclosed in brackets are automatically redacted from the spoken output '
          '(but are still rendered by the model), this can be used for prompt engineering. '
          'Set this to disable this behavior.')
+advanced_group.add_argument(
+    '--voice-cache-dir', type=str, default=VOICE_CACHE_DIR,
+    help='Where decoded voice clips and their conditioning latents are cached, so that using the same voice again is '
+         'nearly free.')
+advanced_group.add_argument(
+    '--disable-voice-cache', default=False, action='store_true',
+    help='Set to always re-load voice clips and re-compute their conditioning latents.')
 advanced_group.add_argument(
     '--device', type=str, default=None,
     help='Device to use for inference.')
@@ -131,6 +139,24 @@ tuning_group.add_argument(
     '--diffusion-temperature', type=float, default=None,
     help='Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0 '
          'are the "mean" prediction of the diffusion network and will sound bland and smeared. ')
+tuning_group.add_argument(
+    '--diffusion-sampler', type=str, default=None, choices=['p_sample', 'ddim', 'dpm_solver'],
+    help='How to sample from the diffusion model. ddim and dpm_solver produce comparable output with far fewer '
+         'diffusion iterations.')
+tuning_group.add_argument(
+    '--ddim-eta', type=float, default=None,
+    help='How much noise the ddim sampler adds at every step. [0,1]. 0 is deterministic.')
+tuning_group.add_argument(
+    '--adaptive-diffusion-tolerance', type=float, default=None,
+    help='Stop diffusing each clip once its predicted spectrogram changes by less than this fraction between steps. '
+         '--diffusion-iterations becomes the maximum number of steps.')
+tuning_group.add_argument(
+    '--diffusion-window', type=int, default=None,
+    help='Diffuse spectrograms longer than this many frames as overlapping windows, which uses less memory on long '
+         'clips.')
+tuning_group.add_argument(
+    '--diffusion-window-overlap', type=int, default=None,
+    help='Minimum number of frames shared by neighbouring diffusion windows.')
 
 usage_examples = f'''
 Examples:
@@ -155,6 +181,8 @@ except SystemExit as e:
         print(usage_examples)
     sys.exit(e.code)
 
+voice_cache_dir = None if args.disable_voice_cache else args.voice_cache_dir
+configure_voice_cache(voice_cache_dir)
 extra_voice_dirs = args.voices_dir.split(',') if args.voices_dir else []
 all_voices = sorted(get_voices(extra_voice_dirs))
 
@@ -207,7 +235,7 @@ seed = int(time.time()) if args.seed is None else args.seed
 if not args.quiet:
     print('Loading tts...')
 tts = TextToSpeech(models_dir=args.models_dir, enable_redaction=not args.disable_redaction,
-                   device=args.device, autoregressive_batch_size=args.batch_size)
+                   device=args.device, autoregressive_batch_size=args.batch_size, voice_cache_dir=voice_cache_dir)
 gen_settings = {
     'use_deterministic_seed': seed,
     'verbose': not args.quiet,
@@ -216,37 +244,46 @@ gen_settings = {
 }
 tuning_options = [
     'num_autoregressive_samples', 'temperature', 'length_penalty', 'repetition_penalty', 'top_p',
-    'max_mel_tokens', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature']
+    'max_mel_tokens', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature',
+    'diffusion_sampler', 'ddim_eta', 'adaptive_diffusion_tolerance', 'diffusion_window', 'diffusion_window_overlap']
 for option in tuning_options:
     if getattr(args, option) is not None:
         gen_settings[option] = getattr(args, option)
 total_clips = len(texts) * len(selected_voices)
 regenerate_clips = [int(x) for x in args.regenerate.split(',')] if args.regenerate else None
 for voice_idx, voice in enumerate(selected_voices):
-    audio_parts = []
     voice_samples, conditioning_latents = load_voices(voice, extra_voice_dirs)
+    parts = {}
+    pending = []
     for text_idx, text in enumerate(texts):
         clip_name = f'{"-".join(voice)}_{text_idx:02d}'
         if args.output_dir:
             first_clip = os.path.join(args.output_dir, f'{clip_name}_00.wav')
             if (args.skip_existing or (regenerate_clips and text_idx not in regenerate_clips)) and os.path.exists(first_clip):
-                audio_parts.append(load_audio(first_clip, 24000))
+                parts[text_idx] = load_audio(first_clip, 24000)
                 if not args.quiet:
                     print(f'Skipping {clip_name}')
                 continue
         if not args.quiet:
             print(f'Rendering {clip_name} ({(voice_idx * len(texts) + text_idx + 1)} of {total_clips})...')
             print('  ' + text)
-        gen = tts.tts_with_preset(
-            text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
-        gen = gen if args.candidates > 1 else [gen]
-        for candidate_idx, audio in enumerate(gen):
-            audio = audio.squeeze(0).cpu()
-            if candidate_idx == 0:
-                audio_parts.append(audio)
-            if args.output_dir:
-                filename = f'{clip_name}_{candidate_idx:02d}.wav'
-                torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+        pending.append(text_idx)
+
+    if pending:
+        # Clips are saved as soon as each group of --batch_size texts is done, so --skip_existing can resume a run.
+        gens = tts.iter_tts_batch_with_preset(
+            [texts[i] for i in pending], voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
+        for text_idx, (gen, _) in zip(pending, gens):
+            clip_name = f'{"-".join(voice)}_{text_idx:02d}'
+            gen = gen if args.candidates > 1 else [gen]
+            for candidate_idx, audio in enumerate(gen):
+                audio = audio.squeeze(0).cpu()
+                if candidate_idx == 0:
+                    parts[text_idx] = audio
+                if args.output_dir:
+                    filename = f'{clip_name}_{candidate_idx:02d}.wav'
+                    torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+    audio_parts = [parts[i] for i in sorted(parts.keys())]
 
     audio = torch.cat(audio_parts, dim=-1)
     if args.output_dir:
@@ -1,3 +1,4 @@
+import functools
 import os
 from glob import glob
 
@@ -8,6 +9,7 @@ import numpy as np
 from scipy.io.wavfile import read
 
 from tortoise.utils.stft import STFT
+from tortoise.utils.voice_cache import VoiceCache, configure_voice_cache, get_voice_cache, hash_file
 
 
 BUILTIN_VOICES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../voices')
@@ -97,7 +99,29 @@ def get_voices(extra_voice_dirs=[]):
     return voices
 
 
-def load_voice(voice, extra_voice_dirs=[]):
+def load_audio_cached(audiopath, sampling_rate, cache=None):
+    """
+    Like load_audio(), but decoded and resampled clips are kept in the given VoiceCache (or the default one from
+    get_voice_cache() if omitted), keyed by the contents of the file.
+    """
+    default_cache = cache is None
+    cache = get_voice_cache() if default_cache else cache
+    if cache is None:
+        return load_audio(audiopath, sampling_rate)
+    key = VoiceCache.make_key('clip', hash_file(audiopath), sampling_rate)
+    audio = cache.get(key)
+    if audio is None:
+        audio = load_audio(audiopath, sampling_rate)
+        try:
+            cache.put(key, audio)
+        except OSError:
+            print(f"Unable to write to the voice cache in {cache.cache_dir}. Voices will not be cached.")
+            if default_cache:
+                configure_voice_cache(None)
+    return audio
+
+
+def load_voice(voice, extra_voice_dirs=[], use_cache=True):
     if voice == 'random':
         return None, None
 
@@ -108,12 +132,12 @@ def load_voice(voice, extra_voice_dirs=[]):
     else:
         conds = []
         for cond_path in paths:
-            c = load_audio(cond_path, 22050)
+            c = load_audio_cached(cond_path, 22050) if use_cache else load_audio(cond_path, 22050)
             conds.append(c)
         return conds, None
 
 
-def load_voices(voices, extra_voice_dirs=[]):
+def load_voices(voices, extra_voice_dirs=[], use_cache=True):
     latents = []
     clips = []
     for voice in voices:
@@ -121,7 +145,7 @@ def load_voices(voices, extra_voice_dirs=[]):
             if len(voices) > 1:
                 print("Cannot combine a random voice with a non-random voice. Just using a random voice.")
             return None, None
-        clip, latent = load_voice(voice, extra_voice_dirs)
+        clip, latent = load_voice(voice, extra_voice_dirs, use_cache=use_cache)
         if latent is None:
             assert len(latents) == 0, "Can only combine raw audio voices or latent voices, not both. Do it yourself if you want this."
             clips.extend(clip)
@@ -140,11 +164,11 @@ def load_voices(voices, extra_voice_dirs=[]):
 class TacotronSTFT(torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
                  n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
-                 mel_fmax=8000.0):
+                 mel_fmax=8000.0, stft_backend='conv'):
         super(TacotronSTFT, self).__init__()
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
-        self.stft_fn = STFT(filter_length, hop_length, win_length)
+        self.stft_fn = STFT(filter_length, hop_length, win_length, backend=stft_backend)
         from librosa.filters import mel as librosa_mel_fn
         mel_basis = librosa_mel_fn(
             sr=sampling_rate, n_fft=filter_length, n_mels=n_mel_channels, fmin=mel_fmin, fmax=mel_fmax)
@@ -180,10 +204,45 @@ class TacotronSTFT(torch.nn.Module):
         return mel_output
 
 
-def wav_to_univnet_mel(wav, do_normalization=False, device='cuda'):
-    stft = TacotronSTFT(1024, 256, 1024, 100, 24000, 0, 12000)
-    stft = stft.to(device)
+@functools.lru_cache(maxsize=None)
+def _get_tacotron_stft(filter_length, hop_length, win_length, n_mel_channels, sampling_rate, mel_fmin, mel_fmax,
+                       stft_backend, device):
+    return TacotronSTFT(filter_length, hop_length, win_length, n_mel_channels, sampling_rate, mel_fmin, mel_fmax,
+                        stft_backend).to(device)
+
+
+def get_tacotron_stft(filter_length=1024, hop_length=256, win_length=1024, n_mel_channels=80, sampling_rate=22050,
+                      mel_fmin=0.0, mel_fmax=8000.0, stft_backend='conv', device='cpu'):
+    """
+    Returns a TacotronSTFT with the given parameters on the given device. Instances are shared between calls, so the
+    STFT bases and the MEL filterbank are only computed once per set of parameters and device.
+    """
+    return _get_tacotron_stft(filter_length, hop_length, win_length, n_mel_channels, sampling_rate, mel_fmin, mel_fmax,
+                              stft_backend, torch.device(device))
+
+
+def wav_to_univnet_mel(wav, do_normalization=False, device='cuda', stft_backend='conv'):
+    """
+    Converts the (b,s) batch of 24kHz waveforms <wav> into the (b,100,s/256) MEL spectrograms used by the diffusion
+    model and the UnivNet vocoder. stft_backend is one of STFT_BACKENDS; 'torch' is faster but not bit-identical.
+    """
+    stft = get_tacotron_stft(1024, 256, 1024, 100, 24000, 0, 12000, stft_backend=stft_backend, device=device)
     mel = stft.mel_spectrogram(wav)
     if do_normalization:
         mel = normalize_tacotron_mel(mel)
     return mel
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_wav_to_univnet_mel_reuses_stft_and_batches(self):
+            self.assertIs(get_tacotron_stft(1024, 256, 1024, 100, 24000, 0, 12000, device='cpu'),
+                          get_tacotron_stft(1024, 256, 1024, 100, 24000, 0, 12000, device=torch.device('cpu')))
+            wavs = torch.rand(3, 24000) * 2 - 1
+            batched = wav_to_univnet_mel(wavs, device='cpu')
+            for i in range(wavs.shape[0]):
+                self.assertTrue(torch.allclose(batched[i:i+1], wav_to_univnet_mel(wavs[i:i+1], device='cpu'), atol=1e-5))
+
+    unittest.main()
@@ -187,6 +187,12 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param fuse_conditioning_free: if True, the conditioned and conditioning-free
+                                   predictions are made in a single forward pass
+                                   over a doubled batch. The model must accept
+                                   fused_conditioning_free=True, meaning that
+                                   the second half of its batch is
+                                   conditioning-free.
     """
 
     def __init__(
@@ -200,6 +206,7 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        fuse_conditioning_free=False,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -208,6 +215,7 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.fuse_conditioning_free = fuse_conditioning_free
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -337,9 +345,13 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and self.fuse_conditioning_free:
+            fused_output = model(th.cat([x, x]), self._scale_timesteps(th.cat([t, t])), fused_conditioning_free=True, **model_kwargs)
+            model_output, model_output_no_conditioning = th.split(fused_output, B)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -376,7 +388,7 @@ class GaussianDiffusion:
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                assert (t == t[0]).all()  # This should only be used in inference, where the whole batch shares a timestep.
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t)[0].item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -541,6 +553,8 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        adaptive_tolerance=None,
+        return_num_steps=False,
     ):
         """
         Generate samples from the model.
@@ -559,6 +573,12 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param adaptive_tolerance: if specified, a sample stops being diffused
+            once its x_start prediction changes by less than this fraction of
+            its norm between two steps, and jumps straight to that prediction.
+            Sampling ends early once every sample in the batch has converged.
+        :param return_num_steps: if True, also return a tensor holding the
+            number of steps each sample took.
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -572,8 +592,11 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             progress=progress,
+            adaptive_tolerance=adaptive_tolerance,
         ):
             final = sample
+        if return_num_steps:
+            return final["sample"], final["num_steps"]
         return final["sample"]
 
     def p_sample_loop_progressive(
@@ -587,6 +610,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        adaptive_tolerance=None,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -594,7 +618,8 @@ class GaussianDiffusion:
 
         Arguments are the same as p_sample_loop().
         Returns a generator over dicts, where each dict is the return value of
-        p_sample().
+        p_sample(), plus a 'num_steps' tensor counting the steps taken by each
+        sample so far.
         """
         if device is None:
             device = next(model.parameters()).device
@@ -604,6 +629,7 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        tracker = _ConvergenceTracker(shape[0], adaptive_tolerance, device)
 
         for i in tqdm(indices, disable=not progress):
             t = th.tensor([i] * shape[0], device=device)
@@ -617,8 +643,11 @@ class GaussianDiffusion:
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
                 )
+                out = tracker.update(out)
                 yield out
                 img = out["sample"]
+                if tracker.done:
+                    break
 
     def ddim_sample(
         self,
@@ -720,6 +749,8 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        adaptive_tolerance=None,
+        return_num_steps=False,
     ):
         """
         Generate samples from the model using DDIM.
@@ -738,8 +769,11 @@ class GaussianDiffusion:
             device=device,
             progress=progress,
             eta=eta,
+            adaptive_tolerance=adaptive_tolerance,
         ):
             final = sample
+        if return_num_steps:
+            return final["sample"], final["num_steps"]
         return final["sample"]
 
     def ddim_sample_loop_progressive(
@@ -754,6 +788,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        adaptive_tolerance=None,
     ):
         """
         Use DDIM to sample from the model and yield intermediate samples from
@@ -776,6 +811,7 @@ class GaussianDiffusion:
 
             indices = tqdm(indices, disable=not progress)
 
+        tracker = _ConvergenceTracker(shape[0], adaptive_tolerance, device)
         for i in indices:
             t = th.tensor([i] * shape[0], device=device)
             with th.no_grad():
@@ -789,8 +825,133 @@ class GaussianDiffusion:
                     model_kwargs=model_kwargs,
                     eta=eta,
                 )
+                out = tracker.update(out)
+                yield out
+                img = out["sample"]
+                if tracker.done:
+                    break
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        adaptive_tolerance=None,
+        return_num_steps=False,
+    ):
+        """
+        Generate samples from the model using the multistep DPM-Solver++
+        (https://arxiv.org/abs/2211.01095), a high-order solver of the
+        diffusion ODE that needs far fewer steps than p_sample_loop(). It works
+        best when the timesteps are spaced evenly in log-SNR; see
+        space_timesteps_by_log_snr().
+
+        Same usage as p_sample_loop().
+        :param order: 1 or 2. Order 1 is equivalent to DDIM with eta=0.
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            order=order,
+            adaptive_tolerance=adaptive_tolerance,
+        ):
+            final = sample
+        if return_num_steps:
+            return final["sample"], final["num_steps"]
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        adaptive_tolerance=None,
+    ):
+        """
+        Use the multistep DPM-Solver++ to sample from the model and yield
+        intermediate samples from each timestep.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        assert order in (1, 2)
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+
+        tracker = _ConvergenceTracker(shape[0], adaptive_tolerance, device)
+        prev_xstart = None
+        prev_h = None
+        for i in tqdm(indices, disable=not progress):
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                # The model is evaluated through p_mean_variance() so that it
+                # sees the same timesteps, conditioning-free guidance and
+                # clipping as the other samplers. Only pred_xstart is used; the
+                # learned variance has no place in the ODE.
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+                xstart = out["pred_xstart"]
+
+                # Step from alphas_cumprod[i] to alphas_cumprod_prev[i] in
+                # terms of the half log-SNR, lambda = log(alpha / sigma).
+                alpha_s = float(np.sqrt(self.alphas_cumprod[i]))
+                sigma_s = float(np.sqrt(1.0 - self.alphas_cumprod[i]))
+                alpha_t = float(np.sqrt(self.alphas_cumprod_prev[i]))
+                sigma_t = float(np.sqrt(1.0 - self.alphas_cumprod_prev[i]))
+                if i == 0 or sigma_t == 0:
+                    # The final step lands on the data (sigma=0), where the
+                    # second order correction is undefined.
+                    sample = xstart * alpha_t
+                    h = None
+                else:
+                    h = math.log(alpha_t / sigma_t) - math.log(alpha_s / sigma_s)
+                    # The step into the first trained timestep is usually a
+                    # much larger jump in log-SNR than the previous one, which
+                    # makes the second order extrapolation unstable, so it is
+                    # taken with first order as well.
+                    if order == 2 and prev_xstart is not None and i > 1:
+                        r = prev_h / h
+                        d = (1 + 1 / (2 * r)) * xstart - (1 / (2 * r)) * prev_xstart
+                    else:
+                        d = xstart
+                    sample = (sigma_t / sigma_s) * img - alpha_t * math.expm1(-h) * d
+                prev_xstart = xstart
+                prev_h = h
+                out = tracker.update({"sample": sample, "pred_xstart": xstart})
                 yield out
                 img = out["sample"]
+                if tracker.done:
+                    break
 
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
@@ -1102,6 +1263,7 @@ class SpacedDiffusion(GaussianDiffusion):
     def __init__(self, use_timesteps, **kwargs):
         self.use_timesteps = set(use_timesteps)
         self.timestep_map = []
+        self.timestep_map_tensors = {}  # (device, dtype) -> timestep_map as a tensor, shared by all wrapped models.
         self.original_num_steps = len(kwargs["betas"])
 
         base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
@@ -1141,7 +1303,7 @@ class SpacedDiffusion(GaussianDiffusion):
             return model
         mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
         return mod(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps, self.timestep_map_tensors
         )
 
     def _scale_timesteps(self, t):
@@ -1205,35 +1367,110 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+def _timestep_map_tensor(timestep_map, map_tensors, ts):
+    """
+    Returns timestep_map as a tensor on the device and with the dtype of ts, caching it in map_tensors.
+    """
+    key = (ts.device, ts.dtype)
+    if key not in map_tensors:
+        map_tensors[key] = th.tensor(timestep_map, device=ts.device, dtype=ts.dtype)
+    return map_tensors[key]
+
+
+def space_timesteps_by_log_snr(betas, count):
+    """
+    Like space_timesteps(), but picks the timesteps so that they are spaced
+    evenly in log signal-to-noise ratio rather than in time. This is the
+    spacing that few-step ODE solvers like DPM-Solver++ are designed for.
+
+    :param betas: the beta schedule of the original process.
+    :param count: the number of timesteps to pick. Fewer may be returned if
+                  the original process is too coarse to tell some apart.
+    :return: a set of diffusion steps from the original process to use.
+    """
+    alphas_cumprod = np.cumprod(1.0 - np.array(betas, dtype=np.float64))
+    log_snr = np.log(alphas_cumprod) - np.log(1.0 - alphas_cumprod)
+    targets = np.linspace(log_snr[-1], log_snr[0], count)
+    # log_snr is decreasing, so search its reversal.
+    reversed_indices = np.searchsorted(log_snr[::-1], targets).clip(0, len(log_snr) - 1)
+    return set(int(i) for i in (len(log_snr) - 1 - reversed_indices))
+
+
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _timestep_map_tensor(self.timestep_map, self.map_tensors, ts)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
 
 
 class _WrappedAutoregressiveModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, x0, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _timestep_map_tensor(self.timestep_map, self.map_tensors, ts)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, x0, new_ts, **kwargs)
 
+class _ConvergenceTracker:
+    """
+    Tracks which samples of a batch have converged during adaptive sampling.
+    A sample has converged once its x_start prediction changes by less than
+    `tolerance` (relative to its norm) between two consecutive steps. From
+    then on it is held at that prediction, which is where the remaining steps
+    would take it anyway.
+    """
+
+    def __init__(self, batch_size, tolerance, device):
+        self.tolerance = tolerance
+        self.num_steps = th.zeros(batch_size, dtype=th.long, device=device)
+        self.converged = th.zeros(batch_size, dtype=th.bool, device=device)
+        self.prev_xstart = None
+        self.final = None
+
+    @property
+    def done(self):
+        return bool(self.converged.all())
+
+    def update(self, out):
+        """
+        Counts the step that produced `out` and replaces the sample and
+        x_start prediction of every converged sample with its final value.
+        """
+        self.num_steps += (~self.converged).long()
+        pred_xstart = out["pred_xstart"]
+        mask_shape = (-1, *([1] * (len(pred_xstart.shape) - 1)))
+        if self.tolerance is not None and self.prev_xstart is not None:
+            dims = list(range(1, len(pred_xstart.shape)))
+            change = (pred_xstart - self.prev_xstart).norm(dim=dims) / \
+                self.prev_xstart.norm(dim=dims).clamp(min=1e-8)
+            newly_converged = (change < self.tolerance) & ~self.converged
+            if self.final is None:
+                self.final = th.zeros_like(pred_xstart)
+            self.final = th.where(newly_converged.view(mask_shape), pred_xstart, self.final)
+            self.converged |= newly_converged
+        if self.converged.any():
+            mask = self.converged.view(mask_shape)
+            out["sample"] = th.where(mask, self.final, out["sample"])
+            out["pred_xstart"] = th.where(mask, self.final, pred_xstart)
+        self.prev_xstart = out["pred_xstart"]
+        out["num_steps"] = self.num_steps.clone()
+        return out
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -1247,4 +1484,85 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
-    return res.expand(broadcast_shape)
\ No newline at end of file
+    return res.expand(broadcast_shape)
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_fused_conditioning_free_matches_separate_passes(self):
+            from tortoise.models.diffusion_decoder import DiffusionTts
+
+            th.manual_seed(0)
+            model = DiffusionTts(model_channels=64, num_layers=2, in_channels=100, out_channels=200, in_latent_channels=64,
+                                 num_heads=4, dropout=0, layer_drop=0, unconditioned_percentage=0).eval()
+            latents = th.randn(2, 20, 64)
+            conditioning = th.randn(1, 128)
+            shape = (2, 100, 86)
+            outputs = []
+            for fuse in (False, True):
+                diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [10]), model_mean_type='epsilon',
+                                           model_var_type='learned_range', loss_type='mse',
+                                           betas=get_named_beta_schedule('linear', 4000), conditioning_free=True,
+                                           conditioning_free_k=2, fuse_conditioning_free=fuse)
+                with th.no_grad():
+                    embeddings = model.timestep_independent(latents, conditioning, shape[-1], False)
+                    th.manual_seed(1)
+                    outputs.append(diffuser.p_sample_loop(model, shape, noise=th.ones(shape),
+                                                          model_kwargs={'precomputed_aligned_embeddings': embeddings}))
+            self.assertTrue(th.allclose(outputs[0], outputs[1], atol=1e-4))
+
+        def test_dpm_solver_solves_gaussian_ode(self):
+            # For data drawn from N(mean, std^2), the optimal epsilon prediction and the end point of the diffusion ODE
+            # are both known in closed form.
+            mean, std = .3, .2
+            betas = get_named_beta_schedule('linear', 4000)
+            alphas_cumprod = th.tensor(np.cumprod(1.0 - betas))
+
+            class GaussianDataModel(th.nn.Module):
+                def forward(self, x, t, **kwargs):
+                    abar = alphas_cumprod[t].view(-1, 1, 1)
+                    xstart = mean + abar.sqrt() * std ** 2 / (abar * std ** 2 + 1 - abar) * (x - abar.sqrt() * mean)
+                    eps = (x - abar.sqrt() * xstart) / (1 - abar).sqrt()
+                    return th.cat([eps, th.zeros_like(eps)], dim=1)
+
+            th.manual_seed(0)
+            noise = th.randn(2, 4, 50, dtype=th.float64)
+            abar_T = alphas_cumprod[-1]
+            expected = mean + std * (noise - abar_T.sqrt() * mean) / (abar_T * std ** 2 + 1 - abar_T).sqrt()
+            errors = {}
+            for sampler in ('dpm_solver', 'ddim'):
+                diffuser = SpacedDiffusion(use_timesteps=space_timesteps_by_log_snr(betas, 20), model_mean_type='epsilon',
+                                           model_var_type='learned_range', loss_type='mse', betas=betas)
+                loop = getattr(diffuser, f'{sampler}_sample_loop')
+                sample = loop(GaussianDataModel(), noise.shape, noise=noise, clip_denoised=False, device='cpu')
+                errors[sampler] = (sample - expected).abs().max().item()
+            self.assertLess(errors['dpm_solver'], .05)
+            self.assertLess(errors['dpm_solver'], errors['ddim'] / 4)
+
+        def test_adaptive_sampling_stops_once_converged(self):
+            betas = get_named_beta_schedule('linear', 4000)
+            alphas_cumprod = th.tensor(np.cumprod(1.0 - betas), dtype=th.float32)
+            target = th.rand(2, 4, 50) - .5
+
+            class FixedTargetModel(th.nn.Module):
+                # Always predicts the same x_start for the first sample, so it converges after two steps.
+                def forward(self, x, t, **kwargs):
+                    abar = alphas_cumprod[t].view(-1, 1, 1)
+                    xstart = th.stack([target[0], x[1] / 2])
+                    eps = (x - abar.sqrt() * xstart) / (1 - abar).sqrt()
+                    return th.cat([eps, th.zeros_like(eps)], dim=1)
+
+            diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [20]), model_mean_type='epsilon',
+                                       model_var_type='learned_range', loss_type='mse', betas=betas)
+            th.manual_seed(0)
+            _, num_steps = diffuser.p_sample_loop(FixedTargetModel(), target.shape, device='cpu', return_num_steps=True)
+            self.assertEqual(num_steps.tolist(), [20, 20])
+            sample, num_steps = diffuser.p_sample_loop(FixedTargetModel(), target.shape, device='cpu',
+                                                       adaptive_tolerance=1e-3, return_num_steps=True)
+            self.assertEqual(num_steps[0].item(), 2)
+            self.assertGreater(num_steps[1].item(), 2)
+            self.assertTrue(th.allclose(sample[0], target[0], atol=1e-4))
+
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+
+import torch
+
+
+class LatentStore:
+    """
+    Holds the autoregressive latents of sampled candidates, keyed by candidate index, so they do not need to be
+    re-computed once the best candidates have been picked. Latents are kept in memory up to a budget; anything past
+    that is spilled to a temporary directory on disk.
+    """
+
+    def __init__(self, memory_budget=None, spill_dir=None):
+        """
+        :param memory_budget: Maximum number of bytes of latents to keep in memory. None means unlimited.
+        :param spill_dir: Directory to spill latents to. If omitted, a temporary directory is created when first needed.
+        """
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.owns_spill_dir = False
+        self.in_memory = {}
+        self.on_disk = {}
+        self.memory_bytes = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self.in_memory) + len(self.on_disk)
+
+    def __contains__(self, index):
+        return index in self.in_memory or index in self.on_disk
+
+    def add(self, index, latent):
+        # Latents are usually rows of a whole sampling batch. Copying them means neither the memory budget nor a spill
+        # file holds on to the rest of the batch.
+        latent = latent.detach().clone()
+        size = latent.numel() * latent.element_size()
+        if self.memory_budget is None or self.memory_bytes + size <= self.memory_budget:
+            self.in_memory[index] = latent
+            self.memory_bytes += size
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='tortoise_latents_')
+            self.owns_spill_dir = True
+        path = os.path.join(self.spill_dir, f'{index}.pth')
+        torch.save(latent.cpu(), path)
+        self.on_disk[index] = (path, latent.device)
+        self.spilled += 1
+
+    def get(self, index):
+        if index in self.in_memory:
+            return self.in_memory[index]
+        path, device = self.on_disk[index]
+        return torch.load(path).to(device)
+
+    def discard(self, index):
+        if index in self.in_memory:
+            latent = self.in_memory.pop(index)
+            self.memory_bytes -= latent.numel() * latent.element_size()
+        elif index in self.on_disk:
+            path, _ = self.on_disk.pop(index)
+            os.remove(path)
+
+    def keep_only(self, indices):
+        """
+        Discards every latent whose index is not in `indices`.
+        """
+        indices = set(indices)
+        for index in list(self.in_memory.keys()) + list(self.on_disk.keys()):
+            if index not in indices:
+                self.discard(index)
+
+    def close(self):
+        for index in list(self.on_disk.keys()):
+            self.discard(index)
+        self.in_memory = {}
+        self.memory_bytes = 0
+        if self.owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self.owns_spill_dir = False
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_rows_of_a_batch_are_stored_alone(self):
+            batch = torch.randn(16, 50, 64)
+            row_bytes = 50 * 64 * 4
+            store = LatentStore(memory_budget=row_bytes)
+            store.add(0, batch[0])
+            store.add(1, batch[1])
+            self.assertEqual(store.memory_bytes, row_bytes)
+            self.assertEqual(store.in_memory[0].untyped_storage().nbytes(), row_bytes)
+            self.assertEqual(store.spilled, 1)
+            path, _ = store.on_disk[1]
+            self.assertLess(os.path.getsize(path), 2 * row_bytes)
+            self.assertTrue(torch.equal(store.get(1), batch[1]))
+            store.keep_only([1])
+            self.assertEqual(store.memory_bytes, 0)
+            store.close()
+            self.assertFalse(os.path.exists(path))
+
+    unittest.main()
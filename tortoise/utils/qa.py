@@ -0,0 +1,185 @@
+import re
+
+import numpy as np
+
+
+def normalize_for_qa(text):
+    """
+    Lowercases text and strips punctuation so that transcripts are compared by their words alone. Apostrophes inside
+    words are kept.
+    """
+    text = re.sub(r"[^a-z0-9']+", ' ', text.lower())
+    return re.sub(r"(?<![a-z0-9])'|'(?![a-z0-9])", '', text).split()
+
+
+def edit_distances(references, hypotheses):
+    """
+    Computes the Levenshtein distance between each pair of sequences (strings, or lists of words or any other hashable
+    items) in one batch. Rows of the edit-distance table are computed for every pair at once with NumPy. Insertions
+    depend on the cell to their left, so each row is first computed from the row above and then fixed up with a
+    cumulative minimum.
+    :return: A numpy array with one distance per pair.
+    """
+    assert len(references) == len(hypotheses)
+    if len(references) == 0:
+        return np.zeros(0, dtype=np.int64)
+    vocab = {}
+    refs = [[vocab.setdefault(item, len(vocab)) for item in ref] for ref in references]
+    hyps = [[vocab.setdefault(item, len(vocab)) for item in hyp] for hyp in hypotheses]
+    ref_lengths = np.array([len(ref) for ref in refs])
+    hyp_lengths = np.array([len(hyp) for hyp in hyps])
+    n, m = int(ref_lengths.max()), int(hyp_lengths.max())
+
+    # Padding never matches anything. It only ever sits right of or below the cells which are read out.
+    ref_ids = np.full((len(refs), n), -1)
+    hyp_ids = np.full((len(hyps), m), -2)
+    for b, (ref, hyp) in enumerate(zip(refs, hyps)):
+        ref_ids[b, :len(ref)] = ref
+        hyp_ids[b, :len(hyp)] = hyp
+
+    batch = np.arange(len(refs))
+    columns = np.arange(m + 1)
+    row = np.tile(columns, (len(refs), 1))
+    distances = row[batch, hyp_lengths].copy()
+    for i in range(1, n + 1):
+        substitution = row[:, :-1] + (ref_ids[:, i - 1:i] != hyp_ids)
+        candidates = np.empty_like(row)
+        candidates[:, 0] = i
+        candidates[:, 1:] = np.minimum(row[:, 1:] + 1, substitution)
+        row = np.minimum.accumulate(candidates - columns, axis=1) + columns
+        finished = ref_lengths == i
+        distances[finished] = row[finished, hyp_lengths[finished]]
+    return distances
+
+
+def edit_distance(reference, hypothesis):
+    return int(edit_distances([reference], [hypothesis])[0])
+
+
+def score_transcripts(gt_texts, transcripts):
+    """
+    Scores a batch of speech-to-text transcripts against the text they should contain.
+    :return: A list with one dict per pair, containing:
+             'wer' and 'cer': The word and character error rates of the normalized transcript.
+             'word_errors', 'words', 'char_errors' and 'chars': The edit distances and reference lengths they come from.
+             'extra_words' and 'extra_chars': How many more words (containing a letter or digit) and characters in
+             those words the transcript has than the text. Large values mean the audio contains speech that should not
+             be there, which is the most common failure of the autoregressive model.
+    """
+    gt_words = [normalize_for_qa(text) for text in gt_texts]
+    stt_words = [normalize_for_qa(text) for text in transcripts]
+    word_errors = edit_distances(gt_words, stt_words)
+    char_errors = edit_distances([' '.join(words) for words in gt_words], [' '.join(words) for words in stt_words])
+
+    scores = []
+    for b, (gt_text, transcript) in enumerate(zip(gt_texts, transcripts)):
+        gt_tokens = [t for t in gt_text.split() if re.search(r'[a-zA-Z0-9]', t)]
+        stt_tokens = [t for t in transcript.split() if re.search(r'[a-zA-Z0-9]', t)]
+        words = len(gt_words[b])
+        chars = len(' '.join(gt_words[b]))
+        scores.append({
+            'wer': int(word_errors[b]) / max(words, 1),
+            'cer': int(char_errors[b]) / max(chars, 1),
+            'word_errors': int(word_errors[b]),
+            'words': words,
+            'char_errors': int(char_errors[b]),
+            'chars': chars,
+            'extra_words': len(stt_tokens) - len(gt_tokens),
+            'extra_chars': sum(len(t) for t in stt_tokens) - sum(len(t) for t in gt_tokens),
+        })
+    return scores
+
+
+def score_transcript(gt_text, transcript):
+    return score_transcripts([gt_text], [transcript])[0]
+
+
+class QAPolicy:
+    """
+    Decides whether a transcript scored by score_transcripts() is close enough to the text it should contain. A
+    transcript fails if it has more than max_extra_words extra words and more than max_extra_chars extra characters,
+    or if its word or character error rate is above max_wer or max_cer. With the defaults, only the first check is
+    made, which is the check tortoise has always used.
+    """
+
+    def __init__(self, max_wer=None, max_cer=None, max_extra_words=1, max_extra_chars=6):
+        """
+        :param max_wer: Highest word error rate which passes. None disables the check.
+        :param max_cer: Highest character error rate which passes. None disables the check.
+        :param max_extra_words: Transcripts with more extra words than this (and more than max_extra_chars extra
+                                characters) fail. None disables the check.
+        :param max_extra_chars: See max_extra_words.
+        """
+        self.max_wer = max_wer
+        self.max_cer = max_cer
+        self.max_extra_words = max_extra_words
+        self.max_extra_chars = max_extra_chars
+
+    def passes(self, score):
+        if self.max_extra_words is not None and score['extra_words'] > self.max_extra_words \
+                and score['extra_chars'] > self.max_extra_chars:
+            return False
+        if self.max_wer is not None and score['wer'] > self.max_wer:
+            return False
+        if self.max_cer is not None and score['cer'] > self.max_cer:
+            return False
+        return True
+
+    def check(self, gt_texts, transcripts):
+        """
+        Scores a batch of transcripts and adds whether each of them passes under 'passed'.
+        """
+        scores = score_transcripts(gt_texts, transcripts)
+        for score in scores:
+            score['passed'] = self.passes(score)
+        return scores
+
+
+def add_qa_arguments(parser):
+    """
+    Adds the arguments which configure a QAPolicy to an argparse parser. See qa_policy_from_args().
+    """
+    parser.add_argument('--qa_max_wer', type=float, default=None,
+                        help='Fail clips whose transcript has a higher word error rate than this.')
+    parser.add_argument('--qa_max_cer', type=float, default=None,
+                        help='Fail clips whose transcript has a higher character error rate than this.')
+
+
+def qa_policy_from_args(args):
+    return QAPolicy(max_wer=args.qa_max_wer, max_cer=args.qa_max_cer)
+
+
+if __name__ == '__main__':
+    import unittest
+
+    def lev_distance(s1, s2):
+        distances = range(len(s1) + 1)
+        for i2, c2 in enumerate(s2):
+            distances_ = [i2 + 1]
+            for i1, c1 in enumerate(s1):
+                distances_.append(distances[i1] if c1 == c2 else 1 + min(distances[i1], distances[i1 + 1], distances_[-1]))
+            distances = distances_
+        return distances[-1]
+
+    class Test(unittest.TestCase):
+        def test_edit_distances(self):
+            rng = np.random.default_rng(0)
+            refs = [''.join(rng.choice(list('abc'), rng.integers(0, 12))) for _ in range(200)]
+            hyps = [''.join(rng.choice(list('abcd'), rng.integers(0, 12))) for _ in range(200)]
+            self.assertEqual(edit_distances(refs, hyps).tolist(), [lev_distance(r, h) for r, h in zip(refs, hyps)])
+            self.assertEqual(edit_distance('kitten'.split(), 'sitting'.split()), 1)
+            self.assertEqual(edit_distance('the cat sat'.split(), 'the cat sat on the mat'.split()), 3)
+
+        def test_score_transcripts(self):
+            score = score_transcript('Hello, world! It\'s me.', 'hello world its me')
+            self.assertEqual((score['word_errors'], score['words'], score['char_errors']), (1, 4, 1))
+            self.assertEqual(score['wer'], .25)
+            self.assertEqual(score_transcript('', '')['wer'], 0)
+
+        def test_policy(self):
+            gt = 'The quick brown fox jumps over the lazy dog.'
+            transcripts = [gt, 'The quick brown fox jumps over the lazy dog and then runs away.', 'The quack brown box.']
+            self.assertEqual([s['passed'] for s in QAPolicy().check([gt] * 3, transcripts)], [True, False, True])
+            self.assertEqual([s['passed'] for s in QAPolicy(max_wer=.3).check([gt] * 3, transcripts)], [True, False, False])
+
+    unittest.main()
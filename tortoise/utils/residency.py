@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def model_size_bytes(model):
+    """
+    Returns the number of bytes taken up by the parameters and buffers of the given module.
+    """
+    size = 0
+    for p in model.parameters():
+        size += p.numel() * p.element_size()
+    for b in model.buffers():
+        size += b.numel() * b.element_size()
+    return size
+
+
+class ModelResidency:
+    """
+    Decides where the models used by TextToSpeech live between calls.
+
+    When disabled, this reproduces the original behavior: a model is moved to the inference device when it is acquired
+    and back to the CPU when it is released. When enabled, released models stay on the device so that subsequent calls
+    do not pay the transfer again. If a memory budget is given, the least recently used models which are not currently
+    acquired are moved back to the CPU to make room for new ones.
+    """
+
+    def __init__(self, device, enabled=False, memory_budget=None):
+        """
+        :param device: The device that models are moved to when acquired.
+        :param enabled: Whether or not models should stay on the device after they are released.
+        :param memory_budget: Maximum number of bytes of model weights to keep resident on the device. None means unlimited.
+        """
+        self.device = device
+        self.enabled = enabled
+        self.memory_budget = memory_budget
+        self.resident = OrderedDict()  # name -> (model, size in bytes), ordered from least to most recently used.
+        self.in_use = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resident_bytes(self):
+        return sum(size for _, size in self.resident.values())
+
+    def acquire(self, name, model):
+        """
+        Makes sure the given model is on the device and marks it as in use. Returns the model.
+        """
+        self.in_use[name] = self.in_use.get(name, 0) + 1
+        if name in self.resident and self.resident[name][0] is model:
+            self.hits += 1
+            self.resident.move_to_end(name)
+            return model
+
+        if not self.enabled:
+            return model.to(self.device)
+
+        self.misses += 1
+        self.resident.pop(name, None)
+        size = model_size_bytes(model)
+        if self.memory_budget is not None:
+            self._evict(self.memory_budget - size)
+            if self.resident_bytes() + size > self.memory_budget:
+                print(f"Model {name} does not fit in the residency budget alongside the models currently in use. "
+                      f"Loading it anyway.")
+        model = model.to(self.device)
+        self.resident[name] = (model, size)
+        return model
+
+    def release(self, name, model):
+        """
+        Marks the given model as no longer in use. Returns the model, which is moved back to the CPU unless residency
+        is enabled.
+        """
+        if self.in_use.get(name, 0) > 0:
+            self.in_use[name] -= 1
+        if not self.enabled:
+            return model.cpu()
+        return model
+
+    @contextmanager
+    def use(self, owner, attr, name=None):
+        """
+        Acquires the model stored in owner.<attr> for the duration of a with block, and releases it again on the way
+        out, even if the block raises. The model returned by acquire() and release() is stored back on owner.
+        :param name: The name the model is tracked under. Defaults to attr.
+        """
+        name = attr if name is None else name
+        setattr(owner, attr, self.acquire(name, getattr(owner, attr)))
+        try:
+            yield getattr(owner, attr)
+        finally:
+            setattr(owner, attr, self.release(name, getattr(owner, attr)))
+
+    def evict(self, name):
+        """
+        Moves the named model back to the CPU, if it is resident.
+        """
+        if name in self.resident:
+            model, _ = self.resident.pop(name)
+            model.cpu()
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Moves every resident model back to the CPU.
+        """
+        for name in list(self.resident.keys()):
+            self.evict(name)
+
+    def _evict(self, target_bytes):
+        for name in list(self.resident.keys()):
+            if self.resident_bytes() <= target_bytes:
+                break
+            if self.in_use.get(name, 0) > 0:
+                continue
+            self.evict(name)
+
+    def stats(self):
+        """
+        Returns counters describing how the residency has behaved so far. Hits and misses are only counted while
+        residency is enabled; with it disabled, every acquire moves the model and none are recorded.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'resident': list(self.resident.keys()),
+            'resident_bytes': self.resident_bytes(),
+        }
+
+
+if __name__ == '__main__':
+    import unittest
+
+    import torch
+
+    class Test(unittest.TestCase):
+        def test_use_releases_on_error(self):
+            class Owner:
+                model = torch.nn.Linear(4, 4)
+
+            owner = Owner()
+            residency = ModelResidency('cpu', enabled=True, memory_budget=0)
+            with self.assertRaises(RuntimeError):
+                with residency.use(owner, 'model'):
+                    self.assertEqual(residency.in_use['model'], 1)
+                    raise RuntimeError()
+            self.assertEqual(residency.in_use['model'], 0)
+            residency._evict(0)
+            self.assertEqual(residency.stats()['resident'], [])
+
+    unittest.main()
@@ -30,6 +30,8 @@ ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+from collections import OrderedDict
+
 import torch
 import numpy as np
 import torch.nn.functional as F
@@ -38,6 +40,9 @@ from scipy.signal import get_window
 from librosa.util import pad_center, tiny
 import librosa.util as librosa_util
 
+# Ways STFT can compute its transforms: 'conv' convolves with windowed Fourier bases, 'torch' uses torch.stft/istft.
+STFT_BACKENDS = ('conv', 'torch')
+
 
 def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
                      n_fft=800, dtype=np.float32, norm=None):
@@ -82,7 +87,7 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
     # Compute the squared window at the desired length
     win_sq = get_window(window, win_length, fftbins=True)
     win_sq = librosa_util.normalize(win_sq, norm=norm)**2
-    win_sq = librosa_util.pad_center(win_sq, n_fft)
+    win_sq = librosa_util.pad_center(win_sq, size=n_fft)
 
     # Fill the envelope
     for i in range(n_frames):
@@ -93,14 +98,22 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
 
 class STFT(torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
+    # Number of (n_frames, device) window envelopes kept by get_window_sum().
+    max_window_sums = 16
+
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(STFT, self).__init__()
+        assert backend in STFT_BACKENDS
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
+        self.backend = backend
         self.forward_transform = None
+        # (n_frames, device) -> (window_sum, approx_nonzero_indices), used by the 'conv' inverse. Ordered from least to
+        # most recently used.
+        self.window_sums = OrderedDict()
         scale = self.filter_length / self.hop_length
         fourier_basis = np.fft.fft(np.eye(self.filter_length))
 
@@ -116,12 +129,17 @@ class STFT(torch.nn.Module):
             assert(filter_length >= win_length)
             # get window and zero center pad it to filter_length
             fft_window = get_window(window, win_length, fftbins=True)
+            # Not persistent, so that the state_dict (and checkpoints holding it) is unchanged.
+            self.register_buffer('torch_window', torch.from_numpy(fft_window).float(), persistent=False)
             fft_window = pad_center(fft_window, size=filter_length)
             fft_window = torch.from_numpy(fft_window).float()
 
             # window the bases
             forward_basis *= fft_window
             inverse_basis *= fft_window
+        else:
+            # The bases are not windowed, whatever win_length is.
+            self.register_buffer('torch_window', torch.ones(filter_length), persistent=False)
 
         self.register_buffer('forward_basis', forward_basis.float())
         self.register_buffer('inverse_basis', inverse_basis.float())
@@ -132,6 +150,11 @@ class STFT(torch.nn.Module):
 
         self.num_samples = num_samples
 
+        if self.backend == 'torch':
+            transform = torch.stft(input_data, self.filter_length, hop_length=self.hop_length,
+                                   win_length=self.torch_window.shape[0], window=self.torch_window, center=True, pad_mode='reflect', return_complex=True)
+            return transform.abs(), transform.angle()
+
         # similar to librosa, reflect-pad the input
         input_data = input_data.view(num_batches, 1, num_samples)
         input_data = F.pad(
@@ -157,6 +180,11 @@ class STFT(torch.nn.Module):
         return magnitude, phase
 
     def inverse(self, magnitude, phase):
+        if self.backend == 'torch':
+            inverse_transform = torch.istft(torch.polar(magnitude, phase), self.filter_length, hop_length=self.hop_length,
+                                            win_length=self.torch_window.shape[0], window=self.torch_window, center=True)
+            return inverse_transform.unsqueeze(1)
+
         recombine_magnitude_phase = torch.cat(
             [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
 
@@ -167,16 +195,8 @@ class STFT(torch.nn.Module):
             padding=0)
 
         if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window, magnitude.size(-1), hop_length=self.hop_length,
-                win_length=self.win_length, n_fft=self.filter_length,
-                dtype=np.float32)
+            window_sum, approx_nonzero_indices = self.get_window_sum(magnitude.size(-1), magnitude.device)
             # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0])
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False)
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
             inverse_transform[:, :, approx_nonzero_indices] /= window_sum[approx_nonzero_indices]
 
             # scale by hop ratio
@@ -187,7 +207,67 @@ class STFT(torch.nn.Module):
 
         return inverse_transform
 
+    def get_window_sum(self, n_frames, device):
+        """
+        Returns the sum-square envelope of the window over n_frames frames and the indices where it is not ~0, which
+        are computed once per number of frames and device. Only the most recently used max_window_sums are kept.
+        """
+        key = (n_frames, device)
+        if key in self.window_sums:
+            self.window_sums.move_to_end(key)
+        else:
+            window_sum = window_sumsquare(
+                self.window, n_frames, hop_length=self.hop_length,
+                win_length=self.win_length, n_fft=self.filter_length,
+                dtype=np.float32)
+            approx_nonzero_indices = torch.from_numpy(
+                np.where(window_sum > tiny(window_sum))[0]).to(device)
+            self.window_sums[key] = (torch.from_numpy(window_sum).to(device), approx_nonzero_indices)
+            while len(self.window_sums) > self.max_window_sums:
+                self.window_sums.popitem(last=False)
+        return self.window_sums[key]
+
     def forward(self, input_data):
         self.magnitude, self.phase = self.transform(input_data)
         reconstruction = self.inverse(self.magnitude, self.phase)
-        return reconstruction
\ No newline at end of file
+        return reconstruction
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_torch_backend_matches_conv_backend(self):
+            torch.manual_seed(0)
+            audio = torch.rand(2, 24000) * 2 - 1
+            for window, win_length in (('hann', 1024), ('hann', 800), (None, 1024)):
+                conv = STFT(1024, 256, win_length, window=window)
+                torch_stft = STFT(1024, 256, win_length, window=window, backend='torch')
+                conv_magnitude, conv_phase = conv.transform(audio)
+                torch_magnitude, torch_phase = torch_stft.transform(audio)
+                self.assertTrue(torch.allclose(conv_magnitude, torch_magnitude, atol=1e-3, rtol=1e-4))
+                # Phase is only meaningful where there is energy.
+                significant = conv_magnitude > 1e-2
+                phase_diff = torch.remainder(conv_phase - torch_phase + np.pi, 2 * np.pi) - np.pi
+                self.assertLess(phase_diff[significant].abs().max().item(), 1e-2)
+
+                conv_audio = conv.inverse(conv_magnitude, conv_phase)
+                torch_audio = torch_stft.inverse(torch_magnitude, torch_phase)
+                self.assertEqual(conv_audio.shape, torch_audio.shape)
+                if window is not None:
+                    # Without a window, the 'conv' inverse does not correct for the missing overlap at the edges.
+                    self.assertTrue(torch.allclose(conv_audio, torch_audio, atol=1e-4))
+                length = torch_audio.shape[-1]
+                for reconstruction in (conv_audio, torch_audio):
+                    self.assertTrue(torch.allclose(reconstruction[:, 0, 1024:length - 1024], audio[:, 1024:length - 1024],
+                                                   atol=1e-4))
+
+        def test_state_dict_and_window_sum_cache(self):
+            stft = STFT(1024, 256, 1024)
+            self.assertEqual(set(stft.state_dict().keys()), {'forward_basis', 'inverse_basis'})
+            for n_frames in range(1, stft.max_window_sums + 5):
+                stft.get_window_sum(n_frames, torch.device('cpu'))
+            self.assertEqual(len(stft.window_sums), stft.max_window_sums)
+            self.assertEqual(next(iter(stft.window_sums))[0], 5)
+
+    unittest.main()
@@ -3,29 +3,32 @@ import re
 
 def split_and_recombine_text(text, desired_length=200, max_length=300):
     """Split text it into chunks of a desired length trying to keep sentences intact."""
+    return list(iter_split_and_recombine_text(text, desired_length, max_length))
+
+
+def iter_split_and_recombine_text(text, desired_length=200, max_length=300):
+    """
+    Generator form of split_and_recombine_text(), which yields each chunk as soon as it is found instead of building
+    the whole list. The current chunk is tracked as a pair of indices into the text rather than as a string that grows
+    and shrinks one character at a time, so the time taken is linear in the length of the text.
+    """
     # normalize text, remove redundant whitespace and convert non-ascii quotes to ascii
     text = re.sub(r'\n\n+', '\n', text)
     text = re.sub(r'\s+', ' ', text)
     text = re.sub(r'[“”]', '"', text)
     text = re.sub(r'\[[0-9]+\]', '', text)
 
-    rv = []
     in_quote = False
-    current = ""
+    start = 0  # The current chunk is text[start:pos + 1].
     split_pos = []
     pos = -1
     end_pos = len(text) - 1
 
     def seek(delta):
-        nonlocal pos, in_quote, current
-        is_neg = delta < 0
+        nonlocal pos, in_quote
+        step = 1 if delta > 0 else -1
         for _ in range(abs(delta)):
-            if is_neg:
-                pos -= 1
-                current = current[:-1]
-            else:
-                pos += 1
-                current += text[pos]
+            pos += step
             if text[pos] == '"':
                 in_quote = not in_quote
         return text[pos]
@@ -35,43 +38,95 @@ def split_and_recombine_text(text, desired_length=200, max_length=300):
         return text[p] if p < end_pos and p >= 0 else ""
 
     def commit():
-        nonlocal rv, current, split_pos
-        rv.append(current)
-        current = ""
+        nonlocal start, split_pos
+        chunk = text[start:pos + 1]
+        start = pos + 1
         split_pos = []
+        return chunk
+
+    def cleaned(chunk):
+        # clean up, remove lines with only whitespace or punctuation
+        chunk = chunk.strip()
+        return chunk if len(chunk) > 0 and not re.match(r'^[\s\.,;:!?]*$', chunk) else None
 
     while pos < end_pos:
         c = seek(1)
         # do we need to force a split?
-        if len(current) >= max_length:
-            if len(split_pos) > 0 and len(current) > (desired_length / 2):
+        if pos - start + 1 >= max_length:
+            if len(split_pos) > 0 and pos - start + 1 > (desired_length / 2):
                 # we have at least one sentence and we are over half the desired length, seek back to the last split
                 d = pos - split_pos[-1]
                 seek(-d)
             else:
                 # no full sentences, seek back until we are not in the middle of a word and split there
-                while c not in '!?.\n ' and pos > 0 and len(current) > desired_length:
+                while c not in '!?.\n ' and pos > 0 and pos - start + 1 > desired_length:
                     c = seek(-1)
-            commit()
+            chunk = cleaned(commit())
+            if chunk is not None:
+                yield chunk
         # check for sentence boundaries
         elif not in_quote and (c in '!?\n' or (c == '.' and peek(1) in '\n ')):
             # seek forward if we have consecutive boundary markers but still within the max length
-            while pos < len(text) - 1 and len(current) < max_length and peek(1) in '!?.':
+            while pos < len(text) - 1 and pos - start + 1 < max_length and peek(1) in '!?.':
                 c = seek(1)
             split_pos.append(pos)
-            if len(current) >= desired_length:
-                commit()
+            if pos - start + 1 >= desired_length:
+                chunk = cleaned(commit())
+                if chunk is not None:
+                    yield chunk
         # treat end of quote as a boundary if its followed by a space or newline
         elif in_quote and peek(1) == '"' and peek(2) in '\n ':
             seek(2)
             split_pos.append(pos)
-    rv.append(current)
+    chunk = cleaned(text[start:pos + 1])
+    if chunk is not None:
+        yield chunk
+
+
+def trie_regex(words):
+    """
+    Builds a regular expression which matches any of the given words, factored into a trie so that the regex engine
+    follows a single branch per character instead of trying every word in turn.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
 
-    # clean up, remove lines with only whitespace or punctuation
-    rv = [s.strip() for s in rv]
-    rv = [s for s in rv if len(s) > 0 and not re.match(r'^[\s\.,;:!?]*$', s)]
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return '(?:' + pattern + ')?' if '' in node else pattern
 
-    return rv
+    return build(trie)
+
+
+class TextNormalizer:
+    """
+    Rewrites text with a list of regex replacements followed by a table of whole-word substitutions (such as
+    abbreviations). Everything is compiled once, and all the substitutions are found in a single scan of the text by
+    one trie-backed regex, whose matches are looked up in the table.
+    """
+
+    def __init__(self, replacements=None, substitutions=None):
+        """
+        :param replacements: Dict of regex -> replacement, applied in order, each to the output of the previous one.
+        :param substitutions: Dict of word -> replacement. Words are only replaced where they are whole words.
+        """
+        self.replacements = [(re.compile(pattern), replacement) for pattern, replacement in (replacements or {}).items()]
+        self.substitutions = dict(substitutions or {})
+        self.substitution_re = re.compile(r'\b' + trie_regex(self.substitutions) + r'\b') if self.substitutions else None
+
+    def __call__(self, text):
+        for pattern, replacement in self.replacements:
+            text = pattern.sub(replacement, text)
+        if self.substitution_re is not None:
+            text = self.substitution_re.sub(lambda m: self.substitutions[m.group(0)], text)
+        return text
 
 
 if __name__ == '__main__':
@@ -130,4 +185,25 @@ if __name__ == '__main__':
                 ]
             )
 
+        def test_iter_split_and_recombine_text(self):
+            text = 'One sentence here. "A quote, with. stops!" Then a longwordthatmustbesplitsomewhere!!! End.' * 50
+            chunks = iter_split_and_recombine_text(text, desired_length=30, max_length=60)
+            self.assertEqual(next(chunks), 'One sentence here. "A quote, with. stops!"')
+            self.assertEqual(['One sentence here. "A quote, with. stops!"'] + list(chunks),
+                             split_and_recombine_text(text, desired_length=30, max_length=60))
+            self.assertEqual(split_and_recombine_text(''), [])
+
+        def test_text_normalizer(self):
+            substitutions = {'II': 'the second', 'WWII': 'World War Two', 'US': 'United States', 'USB': 'U.S.B.'}
+            normalizer = TextNormalizer({r'%': ' percent', r'(\d)\s*-\s*(\d)': r'\1 to \2'}, substitutions)
+            text = 'In WWII the US (not the USB or USA) grew 5-10% and Henry II reigned. BUS USB II.'
+            expected = text
+            for pattern, replacement in normalizer.replacements:
+                expected = pattern.sub(replacement, expected)
+            for word, replacement in substitutions.items():
+                expected = re.sub(r'\b' + word + r'\b', replacement, expected)
+            self.assertEqual(normalizer(text), expected)
+            self.assertEqual(normalizer('US USB'), 'United States U.S.B.')
+            self.assertEqual(TextNormalizer()('unchanged'), 'unchanged')
+
     unittest.main()
@@ -1,10 +1,13 @@
 import os
 import re
+from collections import OrderedDict
 
 import inflect
 import torch
 from tokenizers import Tokenizer
 
+from tortoise.utils.qa import edit_distance
+
 
 # Regular expression matching whitespace:
 from unidecode import unidecode
@@ -151,37 +154,74 @@ def english_cleaners(text):
 
 
 def lev_distance(s1, s2):
-  if len(s1) > len(s2):
-    s1, s2 = s2, s1
-
-  distances = range(len(s1) + 1)
-  for i2, c2 in enumerate(s2):
-    distances_ = [i2 + 1]
-    for i1, c1 in enumerate(s1):
-      if c1 == c2:
-        distances_.append(distances[i1])
-      else:
-        distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
-    distances = distances_
-  return distances[-1]
+  return edit_distance(s1, s2)
 
 
 DEFAULT_VOCAB_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/tokenizer.json')
 
 
 class VoiceBpeTokenizer:
-    def __init__(self, vocab_file=DEFAULT_VOCAB_FILE):
+    def __init__(self, vocab_file=DEFAULT_VOCAB_FILE, cache_size=4096):
+        """
+        :param vocab_file: The tokenizer definition to load.
+        :param cache_size: Number of encoded texts to remember, so that encoding the same text again does not need to
+                           clean and tokenize it again. 0 disables the cache.
+        """
         if vocab_file is not None:
             self.tokenizer = Tokenizer.from_file(vocab_file)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # text -> token ids, ordered from least to most recently used.
+        self.hits = 0
+        self.misses = 0
 
     def preprocess_text(self, txt):
         txt = english_cleaners(txt)
         return txt
 
     def encode(self, txt):
-        txt = self.preprocess_text(txt)
-        txt = txt.replace(' ', '[SPACE]')
-        return self.tokenizer.encode(txt).ids
+        return self.encode_batch([txt])[0]
+
+    def encode_batch(self, txts):
+        """
+        Encodes a list of texts. Texts which are in the cache are not cleaned or tokenized again, and the rest are
+        tokenized in one batch.
+        :return: A list with the token ids of each text.
+        """
+        results = [None] * len(txts)
+        pending = OrderedDict()  # text -> indices in txts, for texts which are not cached.
+        for i, txt in enumerate(txts):
+            if txt in pending:
+                self.hits += 1
+                pending[txt].append(i)
+            elif txt in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(txt)
+                results[i] = list(self.cache[txt])
+            else:
+                self.misses += 1
+                pending[txt] = [i]
+
+        if pending:
+            cleaned = [self.preprocess_text(txt).replace(' ', '[SPACE]') for txt in pending]
+            for (txt, indices), encoding in zip(pending.items(), self.tokenizer.encode_batch(cleaned)):
+                ids = tuple(encoding.ids)
+                for i in indices:
+                    results[i] = list(ids)
+                if self.cache_size > 0:
+                    self.cache[txt] = ids
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
+
+    def cache_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+        }
+
+    def clear_cache(self):
+        self.cache.clear()
 
     def decode(self, seq):
         if isinstance(seq, torch.Tensor):
@@ -190,4 +230,32 @@ class VoiceBpeTokenizer:
         txt = txt.replace('[SPACE]', ' ')
         txt = txt.replace('[STOP]', '')
         txt = txt.replace('[UNK]', '')
-        return txt
\ No newline at end of file
+        return txt
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_encode_batch_matches_encode_and_caches(self):
+            texts = ['Dr. Smith paid $3.50 for 12 apples.', 'Hello world.', 'Dr. Smith paid $3.50 for 12 apples.']
+            tokenizer = VoiceBpeTokenizer(cache_size=2)
+            # Encoded one at a time without the cache, as encode() used to.
+            expected = [tokenizer.tokenizer.encode(tokenizer.preprocess_text(text).replace(' ', '[SPACE]')).ids
+                        for text in texts]
+            for special in ('[STOP]', '[UNK]'):
+                self.assertNotIn(tokenizer.tokenizer.token_to_id(special), sum(expected, []))
+
+            uncached = VoiceBpeTokenizer(cache_size=0)
+            self.assertEqual([uncached.encode(text) for text in texts], expected)
+            self.assertEqual(uncached.cache_stats()['size'], 0)
+
+            self.assertEqual(tokenizer.encode_batch(texts), expected)
+            self.assertEqual(tokenizer.cache_stats(), {'hits': 1, 'misses': 2, 'size': 2})
+            self.assertEqual(tokenizer.encode(texts[1]), expected[1])
+            self.assertEqual(tokenizer.hits, 2)
+
+            tokenizer.encode('Something else.')  # Evicts the least recently used text.
+            self.assertEqual(list(tokenizer.cache.keys()), [texts[1], 'Something else.'])
+
+    unittest.main()
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import tempfile
+
+import torch
+
+
+DEFAULT_VOICE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tortoise', 'voices')
+VOICE_CACHE_DIR = os.environ.get('TORTOISE_VOICE_CACHE_DIR', DEFAULT_VOICE_CACHE_DIR)
+DEFAULT_VOICE_CACHE_SIZE = 1024 ** 3
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 hex digest of the contents of the given file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_tensor(t):
+    """
+    Returns the sha256 hex digest of the given tensor's shape, dtype and contents.
+    """
+    t = t.detach().cpu().contiguous()
+    h = hashlib.sha256(f'{tuple(t.shape)}{t.dtype}'.encode())
+    h.update(t.numpy().tobytes())
+    return h.hexdigest()
+
+
+def checkpoint_fingerprint(paths):
+    """
+    Identifies a set of model checkpoints by their paths, sizes and modification times. Hashing the contents of
+    multi-gigabyte checkpoints would cost more than the computation being cached, and any change to a checkpoint file
+    changes its size or modification time.
+    """
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f'{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+class VoiceCache:
+    """
+    A persistent, content-addressed cache of voice data (decoded reference clips and conditioning latents) stored as
+    torch files in a directory. Entries are keyed by a hash of everything they were computed from, so they never need
+    to be invalidated. When the directory grows past max_size_bytes, the least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir=VOICE_CACHE_DIR, max_size_bytes=DEFAULT_VOICE_CACHE_SIZE):
+        """
+        :param cache_dir: Directory the cache is stored in. It is created if it does not exist.
+        :param max_size_bytes: Maximum total size of the cache directory. None means unlimited.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Combines the given parts (typically hashes and settings) into a single cache key.
+        """
+        return hashlib.sha256('\0'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pth')
+
+    def get(self, key):
+        """
+        Returns the value stored under key, or None if there is none.
+        """
+        path = self.path_for(key)
+        if os.path.exists(path):
+            try:
+                value = torch.load(path, map_location='cpu')
+                os.utime(path)  # Marks the entry as recently used.
+                self.hits += 1
+                return value
+            except (OSError, RuntimeError, EOFError):
+                # A corrupt or concurrently evicted entry is treated as missing.
+                self._remove(path)
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Stores value under key, evicting the least recently used entries if the cache is over its size limit.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, self.path_for(key))
+        finally:
+            self._remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in max_size_bytes.
+        """
+        if self.max_size_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pth'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pth'):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_default_cache = None
+
+
+def configure_voice_cache(cache_dir=VOICE_CACHE_DIR, max_size_bytes=DEFAULT_VOICE_CACHE_SIZE):
+    """
+    Sets up the cache used by load_voice(). Pass cache_dir=None to disable caching.
+    """
+    global _default_cache
+    _default_cache = False
+    if cache_dir is not None:
+        try:
+            _default_cache = VoiceCache(cache_dir, max_size_bytes)
+        except OSError:
+            print(f"Unable to create the voice cache in {cache_dir}. Voices will not be cached.")
+    return get_voice_cache()
+
+
+def get_voice_cache():
+    """
+    Returns the cache used by load_voice(), creating it in VOICE_CACHE_DIR on first use, or None if it is disabled.
+    """
+    global _default_cache
+    if _default_cache is None:
+        try:
+            _default_cache = VoiceCache()
+        except OSError:
+            print(f"Unable to create the voice cache in {VOICE_CACHE_DIR}. Voices will not be cached.")
+            _default_cache = False
+    return _default_cache or None
@@ -1,72 +1,113 @@
 import re
 
+import numpy as np
 import torch
 import torchaudio
 from transformers import Wav2Vec2ForCTC, Wav2Vec2FeatureExtractor, Wav2Vec2CTCTokenizer, Wav2Vec2Processor
 
 from tortoise.utils.audio import load_audio
+from tortoise.utils.residency import ModelResidency
 
 
-def max_alignment(s1, s2, skip_character='~', record=None):
+def max_alignment(s1, s2, skip_character='~'):
     """
     A clever function that aligns s1 to s2 as best it can. Wherever a character from s1 is not found in s2, a '~' is
     used to replace that character.
 
-    Finally got to use my DP skills!
+    Characters which match at the front of both strings are always aligned to each other. Otherwise, the alignment
+    either skips the first character of s2 or replaces the first character of s1 with the skip character, whichever
+    keeps more of s1. The scores of every pair of suffixes are filled in one row of a table at a time, from the end of s1
+    backwards, and the alignment is then read off by walking the table from the front.
     """
-    if record is None:
-        record = {}
     assert skip_character not in s1, f"Found the skip character {skip_character} in the provided string, {s1}"
-    if len(s1) == 0:
+    n, m = len(s1), len(s2)
+    if n == 0:
         return ''
-    if len(s2) == 0:
-        return skip_character * len(s1)
-    if s1 == s2:
-        return s1
-    if s1[0] == s2[0]:
-        return s1[0] + max_alignment(s1[1:], s2[1:], skip_character, record)
-
-    take_s1_key = (len(s1), len(s2) - 1)
-    if take_s1_key in record:
-        take_s1, take_s1_score = record[take_s1_key]
-    else:
-        take_s1 = max_alignment(s1, s2[1:], skip_character, record)
-        take_s1_score = len(take_s1.replace(skip_character, ''))
-        record[take_s1_key] = (take_s1, take_s1_score)
-
-    take_s2_key = (len(s1) - 1, len(s2))
-    if take_s2_key in record:
-        take_s2, take_s2_score = record[take_s2_key]
-    else:
-        take_s2 = max_alignment(s1[1:], s2, skip_character, record)
-        take_s2_score = len(take_s2.replace(skip_character, ''))
-        record[take_s2_key] = (take_s2, take_s2_score)
-
-    return take_s1 if take_s1_score > take_s2_score else skip_character + take_s2
+    if m == 0:
+        return skip_character * n
+
+    # scores[i, j] is the number of characters of s1[i:] which are kept when it is aligned to s2[j:].
+    scores = np.zeros((n + 1, m + 1), dtype=np.int32)
+    chars1 = np.frombuffer(s1.encode('utf-32-le'), dtype=np.uint32)
+    chars2 = np.frombuffer(s2.encode('utf-32-le'), dtype=np.uint32)
+    offset = np.int64(n + 1)  # Larger than any score.
+    for i in range(n - 1, -1, -1):
+        below = scores[i + 1]
+        matches = chars2 == chars1[i]
+        # Where the characters match, the score follows the diagonal. Elsewhere it is the best of skipping s1[i] and
+        # skipping s2[j], where skipping s2[j] carries on along the row up to the next match. That makes the row a
+        # cumulative maximum, taken right to left and restarted at every match, which is done in one pass by lifting
+        # each run between matches above the ones to its right.
+        candidates = np.where(matches, below[1:] + 1, below[:-1])[::-1]
+        runs = np.cumsum(matches[::-1]) * offset
+        scores[i, :m] = (np.maximum.accumulate(candidates + runs) - runs)[::-1]
+
+    aligned = []
+    i = j = 0
+    while i < n:
+        if j == m:
+            aligned.append(skip_character * (n - i))
+            break
+        if s1[i] == s2[j]:
+            aligned.append(s1[i])
+            i += 1
+            j += 1
+        elif scores[i, j + 1] > scores[i + 1, j]:
+            j += 1
+        else:
+            aligned.append(skip_character)
+            i += 1
+    return ''.join(aligned)
 
 
 class Wav2VecAlignment:
     """
     Uses wav2vec2 to perform audio<->text alignment.
     """
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', residency=None):
+        """
+        :param device: Device the wav2vec2 model is run on. Ignored if residency is given.
+        :param residency: ModelResidency which decides whether the wav2vec2 model stays on the device between calls. If
+                          omitted, the model is moved to the device for every call and back to the CPU afterwards.
+        """
         self.model = Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli").cpu()
         self.feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(f"facebook/wav2vec2-large-960h")
         self.tokenizer = Wav2Vec2CTCTokenizer.from_pretrained('jbetker/tacotron-symbols')
-        self.device = device
+        self.residency = ModelResidency(device) if residency is None else residency
+        self.device = self.residency.device
 
     def align(self, audio, expected_text, audio_sample_rate=24000):
-        orig_len = audio.shape[-1]
-
+        return self.align_batch([audio], [expected_text], audio_sample_rate)[0]
+
+    def align_batch(self, audios, expected_texts, audio_sample_rate=24000):
+        """
+        Aligns each of the given (1,S) clips to its expected text, as align() does. The clips are padded to a common
+        length and run through wav2vec2 as a single batch, and the model is only acquired once for all of them.
+        :return: A list with the alignments of each clip.
+        """
+        clips = []
         with torch.no_grad():
-            self.model = self.model.to(self.device)
-            audio = audio.to(self.device)
-            audio = torchaudio.functional.resample(audio, audio_sample_rate, 16000)
-            clip_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
-            logits = self.model(clip_norm).logits
-            self.model = self.model.cpu()
-
-        logits = logits[0]
+            with self.residency.use(self, 'model', 'wav2vec'):
+                for audio in audios:
+                    audio = audio.to(self.device)
+                    audio = torchaudio.functional.resample(audio, audio_sample_rate, 16000)
+                    clips.append((audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7))
+                lengths = torch.tensor([clip.shape[-1] for clip in clips], device=self.device)
+                batch = torch.zeros(len(clips), int(lengths.max()), device=self.device)
+                for i, clip in enumerate(clips):
+                    batch[i, :clip.shape[-1]] = clip[0]
+                attention_mask = (torch.arange(batch.shape[-1], device=self.device).unsqueeze(0) < lengths.unsqueeze(1)).long()
+                logits = self.model(batch, attention_mask=attention_mask).logits
+                logit_lengths = self.model._get_feat_extract_output_lengths(lengths).tolist()
+
+        return [self.alignments_from_logits(logits[i, :logit_lengths[i]], expected_text, audio.shape[-1], clips[i])
+                for i, (audio, expected_text) in enumerate(zip(audios, expected_texts))]
+
+    def alignments_from_logits(self, logits, expected_text, orig_len, audio=None):
+        """
+        Finds the sample in the original clip where each character of expected_text starts, given wav2vec2's (T,V)
+        logits for that clip and its length in samples. `audio` is only used for debugging failed alignments.
+        """
         pred_string = self.tokenizer.decode(logits.argmax(-1).tolist())
 
         fixed_expectation = max_alignment(expected_text.lower(), pred_string)
@@ -123,28 +164,75 @@ class Wav2VecAlignment:
         return alignments[:-1]
 
     def redact(self, audio, expected_text, audio_sample_rate=24000):
-        if '[' not in expected_text:
-            return audio
-        splitted = expected_text.split('[')
-        fully_split = [splitted[0]]
-        for spl in splitted[1:]:
-            assert ']' in spl, 'Every "[" character must be paired with a "]" with no nesting.'
-            fully_split.extend(spl.split(']'))
-
-        # At this point, fully_split is a list of strings, with every other string being something that should be redacted.
-        non_redacted_intervals = []
-        last_point = 0
-        for i in range(len(fully_split)):
-            if i % 2 == 0:
-                end_interval = max(0, last_point + len(fully_split[i]) - 1)
-                non_redacted_intervals.append((last_point, end_interval))
-            last_point += len(fully_split[i])
-
-        bare_text = ''.join(fully_split)
-        alignments = self.align(audio, bare_text, audio_sample_rate)
-
-        output_audio = []
-        for nri in non_redacted_intervals:
-            start, stop = nri
-            output_audio.append(audio[:, alignments[start]:alignments[stop]])
-        return torch.cat(output_audio, dim=-1)
+        return self.redact_batch([audio], [expected_text], audio_sample_rate)[0]
+
+    def redact_batch(self, audios, expected_texts, audio_sample_rate=24000):
+        """
+        Removes the spoken audio of every bracketed part of each clip's expected text, as redact() does. All the clips
+        which need redacting are aligned in a single batch by align_batch(). Clips whose text has no brackets are
+        returned as they are.
+        """
+        to_align = [i for i, text in enumerate(expected_texts) if '[' in text]
+        if not to_align:
+            return list(audios)
+        split_texts = [split_redactions(expected_texts[i]) for i in to_align]
+        alignments = self.align_batch([audios[i] for i in to_align], [bare_text for bare_text, _ in split_texts],
+                                      audio_sample_rate)
+
+        redacted = list(audios)
+        for i, (_, non_redacted_intervals), clip_alignments in zip(to_align, split_texts, alignments):
+            output_audio = []
+            for nri in non_redacted_intervals:
+                start, stop = nri
+                output_audio.append(audios[i][:, clip_alignments[start]:clip_alignments[stop]])
+            redacted[i] = torch.cat(output_audio, dim=-1)
+        return redacted
+
+
+def split_redactions(expected_text):
+    """
+    Splits text containing bracketed redactions into the bare text (without brackets) and the list of (start, end)
+    character intervals of the bare text which should be kept.
+    """
+    splitted = expected_text.split('[')
+    fully_split = [splitted[0]]
+    for spl in splitted[1:]:
+        assert ']' in spl, 'Every "[" character must be paired with a "]" with no nesting.'
+        fully_split.extend(spl.split(']'))
+
+    # At this point, fully_split is a list of strings, with every other string being something that should be redacted.
+    non_redacted_intervals = []
+    last_point = 0
+    for i in range(len(fully_split)):
+        if i % 2 == 0:
+            end_interval = max(0, last_point + len(fully_split[i]) - 1)
+            non_redacted_intervals.append((last_point, end_interval))
+        last_point += len(fully_split[i])
+
+    return ''.join(fully_split), non_redacted_intervals
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_max_alignment(self):
+            self.assertEqual(max_alignment('hello world', 'helo wrld'), 'hel~o w~rld')
+            self.assertEqual(max_alignment('the quick brown fox', 'teh quikc brwn fx'), 't~e qui~k br~wn f~x')
+            self.assertEqual(max_alignment('redacted text', 'text'), '~~~~~te~~~~xt')
+            self.assertEqual(max_alignment('aaa', 'aa'), 'aa~')
+            self.assertEqual(max_alignment('abc', ''), '~~~')
+            self.assertEqual(max_alignment('', 'abc'), '')
+
+        def test_max_alignment_long_text(self):
+            # Far past the recursion limit of the original recursive implementation.
+            text = 'the quick brown fox jumps over the lazy dog. ' * 100
+            self.assertEqual(max_alignment(text, text), text)
+            self.assertEqual(max_alignment(text, text.replace('o', '')), text.replace('o', '~'))
+
+        def test_split_redactions(self):
+            self.assertEqual(split_redactions('[I am really sad,] Please feed me.'),
+                             ('I am really sad, Please feed me.', [(0, 0), (16, 31)]))
+            self.assertEqual(split_redactions('a [b] c [d]'), ('a b c d', [(0, 1), (3, 5), (7, 6)]))
+
+    unittest.main()